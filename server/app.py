@@ -1,52 +1,101 @@
 """ screen/ Flask App entrypoint."""
+import concurrent.futures
+import json
 import pathlib
+import time
 from typing import Any, cast, Optional
 
 import flask
 
 from screen_server import db
 from screen_server import flask_app
+from screen_server import metrics
 from screen_server import models
+from screen_server import render
+from screen_server import services
+from screen_server import transcode
+from screen_server import utils
+from screen_server import variants
 from screen_server.storage import storage
 
 # pyright: reportUnknownArgumentType=false
 
 MY_DIR = pathlib.Path(__file__).parent
-APP = flask_app.get_app(MY_DIR)
-OIDC = flask_app.get_oidc(APP)
-STORAGE = storage.StorageService.get_instance(APP.config)
+OIDC = flask_app.get_oidc()
+# Commands are top-level (e.g., flask initdb) rather than in a group
+ROUTES = flask.Blueprint('screen', __name__, cli_group=None)
 
-# DB caching functions which need flask.g and the APP variable
+def create_app() -> flask.Flask:
+  """ Create the app, e.g. for gunicorn 'app:create_app()'.
+  Storage clients and background threads are created on first use in each
+  process, so this is quick and safe to do before forking workers (e.g., with
+  gunicorn --preload).
+  """
+  app = flask_app.get_app(MY_DIR)
+  OIDC.init_app(app)
+  app.extensions['screen'] = services.Services(app.config)
+  app.register_blueprint(ROUTES)
+  return app
+
+def _services() -> services.Services:
+  """ Get the current app's services. """
+  return flask.current_app.extensions['screen']
+
+# DB caching functions which need flask.g and the app
 def _request_has_connection() -> bool:
   """ Check if a db connection is stored in the global object. """
   return hasattr(flask.g, 'dbconn')
 
 def _get_request_conn():
-  """ Get db connection from global object if it exists, or create new one. """
+  """ Get db connection from global object if it exists, or take from pool. """
   if not _request_has_connection():
-    flask.g.dbconn = db.Db(APP.config['DB_FILE'])
+    flask.g.dbconn = _services().db_pool.get()
 
   return flask.g.dbconn
 
-@APP.teardown_request
-def _close_db_connection(_): # pyright: reportUnusedFunction=false
-  """ Close the db connection on Flask teardown, if it's been created. """
+@ROUTES.teardown_app_request
+def _release_db_connection(_): # pyright: reportUnusedFunction=false
+  """ Release the db connection back to the pool on Flask teardown. """
   if _request_has_connection():
-    flask.g.dbconn.close()
+    flask.g.dbconn.release()
+
+@ROUTES.before_app_request
+def _start_timing():
+  """ Start timing the request, and the work done for it. """
+  flask.g.request_start = time.perf_counter()
+  metrics.start_request()
+
+@ROUTES.after_app_request
+def _record_timing(resp: flask.Response) -> flask.Response:
+  """ Record the request duration, and optionally send the timings. """
+  # Streamed response bodies (e.g., images) are sent after this
+  elapsed = time.perf_counter() - flask.g.request_start
+  metrics.REQUEST_SECONDS.labels(flask.request.endpoint or 'none').observe(
+      elapsed)
+  if flask.current_app.config.get('METRICS_SERVER_TIMING'):
+    resp.headers['Server-Timing'] = metrics.get_server_timing(elapsed)
+  return resp
 
 
-@APP.cli.command('initdb') # pyright: reportUnknownMemberType=false
+@ROUTES.cli.command('initdb') # pyright: reportUnknownMemberType=false
 def initdb():
   """ CLI command to load the schema. """
   schema_file = MY_DIR / 'schema.sql'
-  pathlib.Path(APP.config['DB_FILE']).parent.mkdir(exist_ok=True, parents=True)
+  pathlib.Path(flask.current_app.config['DB_FILE']).parent.mkdir(
+      exist_ok=True, parents=True)
   _get_request_conn().load_schema(schema_file)
   print('Loaded database schema from', schema_file)
 
+@ROUTES.cli.command('reindex')
+def reindex():
+  """ CLI command to rebuild (or backfill) the search index. """
+  count = _get_request_conn().rebuild_search_index()
+  print('Indexed', count, 'images')
+
 ##### Flask Routes
 # SPA HTML
-@APP.route('/')
-@APP.route('/<imageid:image_id>')
+@ROUTES.route('/')
+@ROUTES.route('/<imageid:image_id>')
 @OIDC.require_login
 def spa(image_id: Optional[str] = None) -> flask_app.ResponseType:
   """ Return the index.html for the single page app. """
@@ -54,21 +103,111 @@ def spa(image_id: Optional[str] = None) -> flask_app.ResponseType:
                                user_id=cast(str, OIDC.user_getfield('email')))
 
 # Raw Image
-@APP.route('/i/<image_id>.png')
+@ROUTES.route('/i/<imageid:image_id>.png')
 @OIDC.require_login # The actual username is irrelevant if they're logged in.
 def get_image_data(image_id: str) -> flask_app.ResponseType:
   """ Returns a screenshot image from the filesystem. """
+  return _send_image(image_id)
+
+# Image Variant (e.g., thumbnail)
+@ROUTES.route('/i/<imageid:image_id>_<variant>.png')
+@OIDC.require_login
+def get_image_variant_data(image_id: str,
+                           variant: str) -> flask_app.ResponseType:
+  """ Returns a variant of a screenshot image, creating it if necessary. """
+  if variant == render.VARIANT:
+    return _send_annotated_image(image_id)
+
+  if not variants.VariantService.is_variant(variant):
+    return "Variant Not Found", 404
+
+  return _send_image(image_id, variant)
+
+def _send_annotated_image(image_id: str) -> flask_app.ResponseType:
+  """ Send an image with its annotations drawn on it. """
   img = _get_request_conn().get_image(image_id)
 
   if not img:
     return "Screenshot Not Found", 404
 
+  # The image changes when the annotations do, so the ETag is versioned
+  etag = flask_app.image_etag(image_id, f'{render.VARIANT}_{img.updated}')
+  if flask_app.is_etag_fresh(etag):
+    return flask_app.not_modified(etag, immutable=False)
+
+  return flask_app.send_image(_services().renderer.read_file(img), etag,
+                              last_modified=img.updated, immutable=False)
+
+def _send_image(image_id: str,
+                variant: Optional[str] = None) -> flask_app.ResponseType:
+  """ Send an image, or a variant of it, with caching headers. It's sent in the
+  client's preferred format if it has been transcoded to it, or as PNG.
+  """
+  transcodes = _services().transcodes
+  resp = _send_image_as(image_id, variant,
+                        transcodes.negotiate(flask.request.accept_mimetypes))
+  # The format depends on the formats the client accepts
+  if transcodes.formats and isinstance(resp, flask.Response):
+    resp.vary.add('Accept')
+
+  return resp
+
+def _send_image_as(image_id: str, variant: Optional[str],
+                   fmt: Optional[str]) -> flask_app.ResponseType:
+  """ Send an image, or a variant of it, in a format if available. """
+  etag = flask_app.image_etag(image_id, variant)
+  fmt_etag = (flask_app.image_etag(image_id, transcode.get_variant(variant,
+                                                                   fmt))
+              if fmt else None)
+  # Image bytes are immutable and IDs are never reused, so a client with a
+  # matching ETag can be answered without touching the database or storage.
+  # The client may have been sent the PNG before the image was transcoded.
+  for fresh_etag in (fmt_etag, etag):
+    if fresh_etag and flask_app.is_etag_fresh(fresh_etag):
+      return flask_app.not_modified(fresh_etag)
+
+  img = _get_request_conn().get_image(image_id)
+
+  if not img:
+    return "Screenshot Not Found", 404
+
+  pending = False
+  if fmt and fmt_etag:
+    transcodes = _services().transcodes
+    try:
+      # Storage services may let the client download the transcode directly
+      url = _services().storage.get_url(img.file_id,
+                                        transcode.get_variant(variant, fmt))
+      if url is None:
+        fobj = transcodes.read_file(img.file_id, variant, fmt)
+        if fobj:
+          return flask_app.send_image(fobj, fmt_etag, last_modified=img.created,
+                                      mimetype=storage.CONTENT_TYPES[fmt])
+      elif transcodes.is_ready(img.file_id, variant, fmt):
+        return flask_app.redirect_to_image(url)
+    except FileNotFoundError:
+      pending = True
+
   # pyright: reportGeneralTypeIssues=false
-  return flask.send_file(STORAGE.read_file(img.image_id), mimetype='image/png')
+  if variant:
+    # Variants might not exist yet, so they're never redirected to
+    fobj = _services().variants.read_file(img.file_id, variant)
+  else:
+    # Storage services may let the client download the image directly
+    url = _services().storage.get_url(img.file_id)
+    if url:
+      return flask_app.redirect_to_image(url)
+    fobj = _services().storage.read_file(img.file_id)
+
+  # The PNG sent while the transcode is created is only cached briefly (and
+  # isn't revalidated), so that the client gets the transcode once it exists
+  if pending:
+    return flask_app.send_image(fobj, None, max_age=transcode.PENDING_MAX_AGE)
+  return flask_app.send_image(fobj, etag, last_modified=img.created)
 
 #### API Calls
 # Image GET
-@APP.route('/api/v1/images/<image_id>', methods=['GET'])
+@ROUTES.route('/api/v1/images/<image_id>', methods=['GET'])
 @OIDC.require_login # The actual username is irrelevant if they're logged in.
 def get_image(image_id: str) -> flask_app.ResponseType:
   """ Return a JSON-able image from an image_id. """
@@ -76,24 +215,133 @@ def get_image(image_id: str) -> flask_app.ResponseType:
   if not img:
     return {}, 404
 
-  return img.as_dict()
+  # The stored annotations are sent as-is, rather than decoded and re-encoded
+  return flask_app.json_response(img.as_json())
+
+# Image Batch GET
+@ROUTES.route('/api/v1/images/batch', methods=['GET'])
+@OIDC.require_login
+def get_images() -> flask_app.ResponseType:
+  """ Return JSON-able images for a comma-separated list of image_ids. """
+  image_ids = [image_id for image_id
+               in flask.request.args.get('ids', '').split(',') if image_id]
+  if len(image_ids) > flask.current_app.config.get('BATCH_MAX_IMAGES', 100):
+    return {'error': 'Too many image IDs'}, 400
+
+  images = _get_request_conn().get_images(image_ids)
+  found = {img.image_id for img in images}
+  missing = [image_id for image_id in image_ids if image_id not in found]
+  return flask_app.json_response(
+      f'{{"images": [{", ".join(img.as_json() for img in images)}], '
+      f'"missing": {json.dumps(missing)}}}')
+
+def _get_limit(default: int = 20, maximum: int = 100) -> int:
+  """ Get the limit parameter, clamped so that a page can't be unbounded. """
+  # SQLite treats a negative LIMIT as no limit
+  return max(1, min(flask.request.args.get('limit', default, type=int),
+                    maximum))
+
+# User's Images GET
+@ROUTES.route('/api/v1/users/me/images', methods=['GET'])
+@OIDC.require_login
+def get_my_images() -> flask_app.ResponseType:
+  """ Return a page of the user's images, newest first, without annotations.
+  The next_cursor value is passed as the cursor parameter to get the next page.
+  """
+  limit = _get_limit()
+  cursor = flask.request.args.get('cursor')
+  try:
+    before = utils.decode_cursor(cursor) if cursor else None
+  except ValueError:
+    return {'error': 'Invalid cursor'}, 400
+
+  # Get one extra image to determine whether there's another page
+  images = _get_request_conn().get_images_by_user(
+      cast(str, OIDC.user_getfield('email')), limit + 1, before)
+
+  next_cursor = None
+  if len(images) > limit:
+    images = images[:limit]
+    next_cursor = utils.encode_cursor(images[-1].created, images[-1].image_id)
+
+  return {'images': [img.as_summary_dict() for img in images],
+          'next_cursor': next_cursor}
+
+# Image Search GET
+@ROUTES.route('/api/v1/search', methods=['GET'])
+@OIDC.require_login
+def search_images() -> flask_app.ResponseType:
+  """ Return the user's images, best match first, without annotations. """
+  images = _get_request_conn().search_images(
+      cast(str, OIDC.user_getfield('email')), flask.request.args.get('q', ''),
+      _get_limit())
+  return {'images': [img.as_summary_dict() for img in images]}
 
 # Image POST
-@APP.route('/api/v1/images/', methods=['POST'])
+@ROUTES.route('/api/v1/images/', methods=['POST'])
 @OIDC.require_login
 def new_image() -> flask_app.ResponseType:
   """ Create a new screenshot object from a posted image file. """
   img_file = flask.request.files['img']
+  # Files are stored by a hash of their content, so a duplicate upload shares
+  # the existing file (and its variants) instead of being stored again
   img = models.Image(user_id=cast(str, OIDC.user_getfield('email')),
-                     source_url=flask.request.form.get('source_url'))
-  _get_request_conn().insert_image(img)
+                     source_url=flask.request.form.get('source_url'),
+                     blob_id=utils.hash_file(img_file.stream))
+  conn = _get_request_conn()
 
-  STORAGE.write_file(img.image_id, img_file)
+  # The file is written before the record, so recorded blobs are always stored
+  if not conn.get_existing_blobs([img.file_id]):
+    _services().storage.write_file(img.file_id, img_file)
+    # Thumbnails etc are created in the background, off the request path
+    _services().variants.submit(img.file_id)
+    _services().transcodes.submit_all(img.file_id)
 
+  conn.insert_image(img)
   return img.as_dict()
 
+# Image Batch POST
+@ROUTES.route('/api/v1/images/batch', methods=['POST'])
+@OIDC.require_login
+def new_images() -> flask_app.ResponseType:
+  """ Create several screenshot objects from posted image files.
+  Each file is posted as an img field. Optional source_url fields are matched
+  to the files by position.
+  """
+  img_files = flask.request.files.getlist('img')
+  if len(img_files) > flask.current_app.config.get('BATCH_MAX_IMAGES', 100):
+    return {'error': 'Too many images'}, 400
+
+  source_urls = flask.request.form.getlist('source_url') + [''] * len(img_files)
+  user_id = cast(str, OIDC.user_getfield('email'))
+  images = [models.Image(user_id=user_id, source_url=source_url or None,
+                         blob_id=utils.hash_file(img_file.stream))
+            for source_url, img_file in zip(source_urls, img_files)]
+  conn = _get_request_conn()
+
+  # Each distinct file which isn't already stored is written once
+  existing = conn.get_existing_blobs(list({img.file_id for img in images}))
+  new_files = {img.file_id: img_file for img, img_file in zip(images, img_files)
+               if img.file_id not in existing}
+
+  # Files are written first (and concurrently) so that a failed write doesn't
+  # leave records without images
+  if new_files:
+    store = _services().storage
+    max_workers = flask.current_app.config.get('BATCH_UPLOAD_WORKERS', 8)
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(len(new_files), max_workers)) as executor:
+      list(executor.map(store.write_file, new_files, new_files.values()))
+
+  conn.insert_images(images)
+  for file_id in new_files:
+    _services().variants.submit(file_id)
+    _services().transcodes.submit_all(file_id)
+
+  return {'images': [img.as_dict() for img in images]}
+
 # Image PUT
-@APP.route('/api/v1/images/<image_id>', methods=['PUT'])
+@ROUTES.route('/api/v1/images/<image_id>', methods=['PUT'])
 @OIDC.require_login
 def update_image(image_id: str) -> flask_app.ResponseType:
   """ Update image in datastore from JSON. """
@@ -102,6 +350,49 @@ def update_image(image_id: str) -> flask_app.ResponseType:
   assert image_id == image.image_id
   # The DB class only updates the record if the user_id matches with what is in
   # the database. This will silently fail otherwise.
-  _get_request_conn().update_image(image,
-                                   cast(str, OIDC.user_getfield('email')))
+  if _get_request_conn().update_image(image,
+                                      cast(str, OIDC.user_getfield('email'))):
+    _services().renderer.submit(image_id)
   return "Success", 200
+
+# Image PATCH
+@ROUTES.route('/api/v1/images/<image_id>', methods=['PATCH'])
+@OIDC.require_login
+def patch_image(image_id: str) -> flask_app.ResponseType:
+  """ Apply annotation operations to an image, if it's unchanged.
+  The JSON body has the image's last-known updated value and a list of ops,
+  each of which is {"op": "append", "annotation": ...},
+  {"op": "replace", "index": ..., "annotation": ...} or
+  {"op": "delete", "index": ...}. Indexes refer to the annotations as modified
+  by the preceding ops.
+  """
+  body = flask.request.get_json()
+  if not isinstance(body, dict) or not isinstance(
+      body.get('updated'), int) or not isinstance(body.get('ops'), list):
+    return {'error': 'updated and ops are required'}, 400
+
+  try:
+    updated = _get_request_conn().patch_annotations(
+        image_id, cast(str, OIDC.user_getfield('email')), body['updated'],
+        body['ops'])
+  except db.UpdateConflictError as exc:
+    return {'error': 'Image has been changed', 'updated': exc.updated}, 409
+  except ValueError as exc:
+    return {'error': str(exc)}, 400
+
+  if updated is None:
+    return {}, 404
+
+  _services().renderer.submit(image_id)
+  return {'updated': updated}
+
+# Prometheus Metrics
+@ROUTES.route('/metrics', methods=['GET'])
+def get_metrics() -> flask_app.ResponseType:
+  """ Return metrics in the Prometheus text format, if enabled. """
+  # Scrapers can't log in, so access should be restricted by the proxy instead
+  if not flask.current_app.config.get('METRICS_ENABLED'):
+    return "Not Found", 404
+
+  return flask.Response(metrics.generate_latest(),
+                        content_type=metrics.CONTENT_TYPE)
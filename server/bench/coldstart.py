@@ -0,0 +1,196 @@
+""" Cold start benchmark for the screen/ server, run under gunicorn.
+
+Measures the time from starting gunicorn to its first response, and to the
+first completed upload (which is when the storage backend is first used), for
+each backend and mode:
+
+  fork     Each worker imports the app and creates its backends on first use
+  preload  The app is imported once, before forking (gunicorn --preload), and
+           each worker creates its backends on first use
+  eager    Each worker imports the app and creates its backends immediately,
+           as the app did before it had a factory
+
+Results are written as JSON. Run from the server directory:
+
+  python bench/coldstart.py --backends LOCAL,S3 --runs 5 --output out.json
+"""
+import argparse
+import datetime
+import http.client
+import json
+import os
+import pathlib
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent))
+
+# pylint: disable=wrong-import-position
+import load
+
+MODES = ('fork', 'preload', 'eager')
+
+def build_app() -> Any:
+  """ Build the app in a gunicorn process, as the bench user. """
+  load.stub_app_environment()
+  # pylint: disable=import-outside-toplevel
+  import app
+
+  application = app.create_app()
+  if os.environ.get('BENCH_EAGER'):
+    # Accessing any service creates them all
+    _ = application.extensions['screen'].storage
+  return application
+
+def wait_for_response(port: int, request: load.Request,
+                      deadline: float) -> http.client.HTTPResponse:
+  """ Make a request, retrying until the server is listening. """
+  while True:
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    try:
+      conn.request(request.method, request.path, request.body, request.headers)
+      resp = conn.getresponse()
+      resp.read()
+      return resp
+    except ConnectionRefusedError:
+      if time.perf_counter() > deadline:
+        raise
+      time.sleep(0.005)
+    finally:
+      conn.close()
+
+def run_once(mode: str, config: dict[str, str], workers: int,
+             png: bytes) -> dict[str, float]:
+  """ Start gunicorn and time its first response and first upload. """
+  with tempfile.TemporaryDirectory(prefix='screen-bench-') as workdir:
+    env = load.get_server_env(pathlib.Path(workdir), config)
+    with sqlite3.connect(env['FLASK_DB_FILE']) as conn:
+      conn.executescript(
+          (load.SERVER_DIR / 'schema.sql').read_text(encoding='ascii'))
+    if mode == 'eager':
+      env['BENCH_EAGER'] = '1'
+
+    port = load.free_port()
+    command = [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}',
+               '--workers', str(workers), '--pythonpath',
+               str(pathlib.Path(__file__).resolve().parent),
+               '--log-level', 'warning']
+    if mode == 'preload':
+      command.append('--preload')
+    command.append('coldstart:build_app()')
+
+    # Background work (e.g., variants) can log errors when the server stops, so
+    # the server's output is only shown if it fails
+    log_path = pathlib.Path(workdir, 'server.log')
+    with open(log_path, 'wb') as log:
+      start = time.perf_counter()
+      process = subprocess.Popen(command, cwd=load.SERVER_DIR, env=env,
+                                 stdout=log, stderr=subprocess.STDOUT)
+    try:
+      # A missing image only needs the database
+      resp = wait_for_response(
+          port, load.Request('GET', '/api/v1/images/aaaaaaaaaaaaa'),
+          start + 60)
+      first_response = time.perf_counter() - start
+      if resp.status != 404:
+        raise RuntimeError(f'Unexpected status {resp.status}')
+
+      resp = wait_for_response(
+          port, load.make_upload(png, 'https://example.com/coldstart'),
+          start + 60)
+      first_upload = time.perf_counter() - start
+      if resp.status != 200:
+        raise RuntimeError(f'Upload failed with status {resp.status}')
+    finally:
+      process.terminate()
+      process.wait()
+      if sys.exc_info()[0]:
+        sys.stderr.write(log_path.read_text(encoding='utf-8',
+                                            errors='replace'))
+
+  return {'first_response_s': round(first_response, 4),
+          'first_upload_s': round(first_upload, 4)}
+
+def parse_args() -> argparse.Namespace:
+  """ Parse command line arguments. """
+  def csv(value: str) -> list[str]:
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+  parser = argparse.ArgumentParser(description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--backends', type=csv, default=['LOCAL'],
+                      help=f'Comma-separated backends, from {load.BACKENDS}')
+  parser.add_argument('--modes', type=csv, default=list(MODES),
+                      help=f'Comma-separated modes, from {MODES}')
+  parser.add_argument('--runs', type=int, default=5,
+                      help='Number of cold starts per backend and mode')
+  parser.add_argument('--workers', type=int, default=2,
+                      help='Number of gunicorn workers')
+  parser.add_argument('--local-cache', action='store_true',
+                      help='Use the local cache with cloud backends')
+  parser.add_argument('--gcs-endpoint',
+                      help='URL of a fake-gcs-server, for the GCS backend')
+  parser.add_argument('--output', type=pathlib.Path,
+                      help='File to write JSON results to, instead of stdout')
+
+  args = parser.parse_args()
+  for name, values, allowed in (('backend', args.backends, load.BACKENDS),
+                                ('mode', args.modes, MODES)):
+    for value in values:
+      if value not in allowed:
+        parser.error(f'{value} is not a valid {name}')
+  return args
+
+def main() -> None:
+  """ Run the benchmarks and output the results. """
+  args = parse_args()
+  report: dict[str, Any] = {
+    'started': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    'commit': load.get_git_commit(),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'cpus': os.cpu_count(),
+    'args': {key: value for key, value in vars(args).items()
+             if key != 'output'},
+    'results': [],
+  }
+
+  png = load.make_png(320, 240, 0)
+  stand_ins: list[Any] = []
+  try:
+    for backend in args.backends:
+      config = load.get_backend_config(backend, args, stand_ins)
+      for mode in args.modes:
+        runs = [run_once(mode, config, args.workers, png)
+                for _ in range(args.runs)]
+        result = {
+          'backend': backend,
+          'mode': mode,
+          'runs': runs,
+          'median_first_response_s': round(statistics.median(
+              run['first_response_s'] for run in runs), 4),
+          'median_first_upload_s': round(statistics.median(
+              run['first_upload_s'] for run in runs), 4),
+        }
+        print(f'{backend} {mode}: first response '
+              f'{result["median_first_response_s"]}s, first upload '
+              f'{result["median_first_upload_s"]}s', file=sys.stderr)
+        report['results'].append(result)
+  finally:
+    for stand_in in stand_ins:
+      stand_in.close()
+
+  output = json.dumps(report, indent=2)
+  if args.output:
+    args.output.write_text(output + '\n', encoding='utf-8')
+  else:
+    print(output)
+
+if __name__ == '__main__':
+  main()
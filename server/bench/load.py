@@ -0,0 +1,515 @@
+""" Load and latency benchmarks for the screen/ server.
+
+The app is run in a separate process, with OIDC stubbed out and config files
+ignored, against the LOCAL storage backend or local stand-ins for S3 (moto) and
+GCS (fake-gcs-server). Each scenario is run at each concurrency level and image
+size, and results are written as JSON. Run from the server directory:
+
+  python bench/load.py --backends LOCAL,S3 --concurrency 1,8 --output out.json
+"""
+import argparse
+import dataclasses
+import datetime
+import http.client
+import json
+import logging
+import os
+import pathlib
+import platform
+import random
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+import zlib
+from typing import Any, Iterator, Optional
+
+SERVER_DIR = pathlib.Path(__file__).resolve().parent.parent
+
+USER_ID = 'bench@example.com'
+BUCKET = 'screen-bench'
+
+BACKENDS = ('LOCAL', 'S3', 'GCS')
+SCENARIOS = ('upload', 'fetch', 'metadata', 'annotate')
+
+ANNOTATIONS = [
+  ['Box', {'start': ['P', [10, 10]], 'last': ['P', [120, 80]]}],
+  ['Arrow', {'start': ['P', [20, 100]], 'last': ['P', [140, 40]]}],
+  ['Text', {'start': ['P', [30, 30]], 'text': 'Benchmark'}],
+]
+""" Annotations saved by the annotate scenario. """
+
+@dataclasses.dataclass
+class Request():
+  """ A single HTTP request made by a scenario. """
+  method: str
+  path: str
+  body: bytes = b''
+  headers: dict[str, str] = dataclasses.field(default_factory=dict)
+
+
+@dataclasses.dataclass
+class Result():
+  """ Measurements from running one scenario. """
+  backend: str
+  scenario: str
+  image_size: str
+  concurrency: int
+  requests: int
+  errors: int
+  duration_s: float
+  throughput_rps: float
+  latency_ms: dict[str, float]
+  peak_rss_bytes: Optional[int]
+
+
+def png_chunk(kind: bytes, data: bytes) -> bytes:
+  """ Build a PNG chunk. """
+  return (struct.pack('>I', len(data)) + kind + data
+          + struct.pack('>I', zlib.crc32(kind + data)))
+
+def make_png(width: int, height: int, seed: int) -> bytes:
+  """ Build an RGB PNG of random noise, which doesn't compress. """
+  rng = random.Random(seed)
+  raw = b''.join(b'\x00' + rng.randbytes(width * 3) for _ in range(height))
+
+  return (b'\x89PNG\r\n\x1a\n'
+          + png_chunk(b'IHDR',
+                      struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+          + png_chunk(b'IDAT', zlib.compress(raw, 1))
+          + png_chunk(b'IEND', b''))
+
+def make_unique(png: bytes) -> bytes:
+  """ Return a copy of a PNG with a unique comment, so that uploads of it are
+  stored separately rather than deduplicated.
+  """
+  # The comment goes before the IEND chunk, which is the last 12 bytes
+  comment = png_chunk(b'tEXt', b'Comment\x00' + uuid.uuid4().hex.encode())
+  return png[:-12] + comment + png[-12:]
+
+def make_upload(data: bytes, source_url: str) -> Request:
+  """ Build a multipart image upload request. """
+  boundary = uuid.uuid4().hex
+  body = b''.join([
+    f'--{boundary}\r\n'.encode(),
+    b'Content-Disposition: form-data; name="source_url"\r\n\r\n',
+    source_url.encode(), b'\r\n',
+    f'--{boundary}\r\n'.encode(),
+    b'Content-Disposition: form-data; name="img"; filename="bench.png"\r\n',
+    b'Content-Type: image/png\r\n\r\n',
+    data, b'\r\n',
+    f'--{boundary}--\r\n'.encode(),
+  ])
+  return Request('POST', '/api/v1/images/', body, {
+      'Content-Type': f'multipart/form-data; boundary={boundary}'})
+
+def percentile(values: list[float], pct: float) -> float:
+  """ Return the nearest-rank percentile of sorted values. """
+  if not values:
+    return 0.0
+  rank = max(1, round(pct / 100 * len(values)))
+  return values[min(rank, len(values)) - 1]
+
+def free_port() -> int:
+  """ Find a free local TCP port. """
+  with socket.socket() as sock:
+    sock.bind(('127.0.0.1', 0))
+    return sock.getsockname()[1]
+
+def reset_peak_rss(pid: int) -> None:
+  """ Reset a process's peak RSS (Linux only), to measure it per scenario. """
+  try:
+    pathlib.Path(f'/proc/{pid}/clear_refs').write_text('5', encoding='ascii')
+  except OSError:
+    pass
+
+def get_peak_rss(pid: int) -> Optional[int]:
+  """ Return a process's peak RSS in bytes, or None if it's unavailable. """
+  try:
+    status = pathlib.Path(f'/proc/{pid}/status').read_text(encoding='ascii')
+  except OSError:
+    return None
+
+  for line in status.splitlines():
+    if line.startswith('VmHWM:'):
+      return int(line.split()[1]) * 1024
+  return None
+
+def get_git_commit() -> Optional[str]:
+  """ Return the commit being benchmarked, if it can be found. """
+  try:
+    return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=SERVER_DIR,
+                          capture_output=True, check=True,
+                          text=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+##### Server process
+def stub_app_environment() -> None:
+  """ Log every request in as the same user, and ignore config files.
+  This must be called before the app is imported.
+  """
+  # pylint: disable=import-outside-toplevel
+  import dotenv
+  import flask_oidc
+
+  flask_oidc.OpenIDConnect.require_login = lambda self, view: view
+  flask_oidc.OpenIDConnect.user_getfield = (
+      lambda self, field, access_token=None: USER_ID)
+  # A developer's config files would make results depend on the machine
+  dotenv.load_dotenv = lambda *args, **kwargs: False
+
+  sys.path.insert(0, str(SERVER_DIR))
+
+def serve() -> None:
+  """ Run the app on a free port, as the same logged in user for every request.
+  The chosen port is printed to stdout once the server is ready.
+  """
+  # pylint: disable=import-outside-toplevel
+  from werkzeug import serving
+
+  stub_app_environment()
+  import app
+
+  application = app.create_app()
+  dbconn = application.extensions['screen'].db_pool.get()
+  dbconn.load_schema(app.MY_DIR / 'schema.sql')
+  dbconn.release()
+
+  logging.getLogger('werkzeug').setLevel(logging.ERROR)
+  # Keep-alive connections, as a proxy in front of gunicorn would use
+  serving.WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+  server = serving.make_server('127.0.0.1', 0, application, threaded=True)
+  print(server.server_port, flush=True)
+  server.serve_forever()
+
+
+def get_server_env(workdir: pathlib.Path,
+                   config: dict[str, str]) -> dict[str, str]:
+  """ Return the environment to run the app in, with its files in workdir. """
+  secrets = workdir / 'client_secrets.json'
+  secrets.write_text(json.dumps({'web': {
+    'client_id': 'bench', 'client_secret': 'bench',
+    'auth_uri': 'http://localhost/auth',
+    'token_uri': 'http://localhost/token',
+    'issuer': 'http://localhost', 'redirect_uris': ['http://localhost/'],
+  }}), encoding='ascii')
+
+  env = dict(os.environ)
+  env.update({
+    'FLASK_DB_FILE': str(workdir / 'screen.sqlite3'),
+    'FLASK_OIDC_CLIENT_SECRETS': str(secrets),
+    'FLASK_SECRET_KEY': 'bench',
+    'FLASK_STORAGE_LOCAL_DIR': str(workdir / 'images'),
+  })
+  env.update({f'FLASK_{key}': value for key, value in config.items()})
+  return env
+
+
+class Server():
+  """ The app, running in a child process with the given config. """
+  def __init__(self, config: dict[str, str]):
+    self.workdir = tempfile.TemporaryDirectory(prefix='screen-bench-')
+    env = get_server_env(pathlib.Path(self.workdir.name), config)
+
+    self.process = subprocess.Popen(
+        [sys.executable, __file__, '--serve'], cwd=SERVER_DIR, env=env,
+        stdout=subprocess.PIPE, text=True)
+    assert self.process.stdout
+    port = self.process.stdout.readline().strip()
+    if not port:
+      self.close()
+      raise RuntimeError('Server failed to start')
+    self.port = int(port)
+
+  @property
+  def pid(self) -> int:
+    """ The server's process ID. """
+    return self.process.pid
+
+  def close(self) -> None:
+    """ Stop the server and delete its files. """
+    self.process.terminate()
+    self.process.wait()
+    self.workdir.cleanup()
+
+
+##### Storage stand-ins
+class MotoS3():
+  """ Local moto server standing in for S3. """
+  def __init__(self):
+    # pylint: disable=import-outside-toplevel
+    from moto import server
+
+    port = free_port()
+    self.server = server.ThreadedMotoServer(ip_address='127.0.0.1', port=port,
+                                            verbose=False)
+    self.server.start()
+    # moto logs every request
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    self.endpoint_url = f'http://127.0.0.1:{port}'
+    urllib.request.urlopen(urllib.request.Request(
+        f'{self.endpoint_url}/{BUCKET}', method='PUT'))
+
+  def get_config(self) -> dict[str, str]:
+    """ Return the app config for using this stand-in. """
+    return {
+      'STORAGE_SERVICE': 'S3',
+      'STORAGE_S3_BUCKET': BUCKET,
+      'STORAGE_S3_KEY': 'bench',
+      'STORAGE_S3_SECRET': 'bench',
+      'STORAGE_S3_ENDPOINT_URL': self.endpoint_url,
+    }
+
+  def close(self) -> None:
+    """ Stop the stand-in. """
+    self.server.stop()
+
+
+class FakeGcs():
+  """ An already running fake-gcs-server standing in for GCS. """
+  def __init__(self, endpoint_url: str):
+    self.endpoint_url = endpoint_url.rstrip('/')
+    try:
+      urllib.request.urlopen(urllib.request.Request(
+          f'{self.endpoint_url}/storage/v1/b?project=bench', method='POST',
+          data=json.dumps({'name': BUCKET}).encode(),
+          headers={'Content-Type': 'application/json'}))
+    except urllib.error.HTTPError as exc:
+      # The bucket exists from a previous run
+      if exc.code != 409:
+        raise
+
+  def get_config(self) -> dict[str, str]:
+    """ Return the app config for using this stand-in. """
+    return {
+      'STORAGE_SERVICE': 'GCS',
+      'STORAGE_GCS_BUCKET': BUCKET,
+      'STORAGE_GCS_ENDPOINT_URL': self.endpoint_url,
+    }
+
+  def close(self) -> None:
+    """ Nothing to stop, since the stand-in is run separately. """
+
+
+##### Load generation
+def run_requests(port: int, requests: list[Request],
+                 concurrency: int) -> tuple[list[float], int,
+                                            list[bytes], float]:
+  """ Make the requests using concurrency connections.
+  Returns the sorted latencies in seconds, the number of errors, the response
+  bodies (in request order) and the elapsed time.
+  """
+  latencies: list[float] = []
+  bodies: list[bytes] = [b''] * len(requests)
+  errors = 0
+  lock = threading.Lock()
+  next_index = iter(range(len(requests)))
+
+  def worker() -> None:
+    nonlocal errors
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    for index in iter(lambda: next(next_index, None), None):
+      request = requests[index]
+      start = time.perf_counter()
+      try:
+        conn.request(request.method, request.path, request.body,
+                     request.headers)
+        resp = conn.getresponse()
+        body = resp.read()
+        failed = resp.status >= 400
+      except (OSError, http.client.HTTPException):
+        conn.close()
+        body, failed = b'', True
+      elapsed = time.perf_counter() - start
+
+      with lock:
+        latencies.append(elapsed)
+        bodies[index] = body
+        errors += failed
+    conn.close()
+
+  start = time.perf_counter()
+  threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  return sorted(latencies), errors, bodies, time.perf_counter() - start
+
+def build_requests(scenario: str, count: int, png: bytes,
+                   images: list[dict[str, Any]]) -> list[Request]:
+  """ Build the requests for a scenario, cycling through uploaded images. """
+  if scenario == 'upload':
+    return [make_upload(make_unique(png), f'https://example.com/bench/{index}')
+            for index in range(count)]
+
+  requests: list[Request] = []
+  for index in range(count):
+    image = images[index % len(images)]
+    if scenario == 'fetch':
+      requests.append(Request('GET', f'/i/{image["image_id"]}.png'))
+    elif scenario == 'metadata':
+      requests.append(Request('GET', f'/api/v1/images/{image["image_id"]}'))
+    else:
+      body = json.dumps(dict(image, annotations=ANNOTATIONS[:index % 3 + 1]))
+      requests.append(Request('PUT', f'/api/v1/images/{image["image_id"]}',
+                              body.encode(),
+                              {'Content-Type': 'application/json'}))
+  return requests
+
+def run_backend(backend: str, config: dict[str, str],
+                args: argparse.Namespace) -> Iterator[Result]:
+  """ Run every scenario against a fresh server for the backend. """
+  server = Server(config)
+  try:
+    for size in args.sizes:
+      width, height = (int(dim) for dim in size.split('x'))
+      png = make_png(width, height, args.seed)
+      images: list[dict[str, Any]] = []
+
+      for concurrency in args.concurrency:
+        for scenario in args.scenarios:
+          if scenario != 'upload' and not images:
+            raise RuntimeError(f'{scenario} requires uploaded images')
+
+          requests = build_requests(scenario, args.warmup + args.requests, png,
+                                    images)
+          run_requests(server.port, requests[:args.warmup], 1)
+
+          reset_peak_rss(server.pid)
+          latencies, errors, bodies, duration = run_requests(
+              server.port, requests[args.warmup:], concurrency)
+
+          if scenario == 'upload':
+            images.extend(json.loads(body) for body in bodies if body)
+
+          yield Result(
+              backend=backend, scenario=scenario, image_size=size,
+              concurrency=concurrency, requests=len(latencies), errors=errors,
+              duration_s=round(duration, 4),
+              throughput_rps=round(len(latencies) / duration, 2),
+              latency_ms={
+                'p50': round(percentile(latencies, 50) * 1000, 3),
+                'p99': round(percentile(latencies, 99) * 1000, 3),
+                'mean': round(sum(latencies) / len(latencies) * 1000, 3),
+                'max': round(latencies[-1] * 1000, 3),
+              },
+              peak_rss_bytes=get_peak_rss(server.pid))
+
+          # Let background work (e.g., variants of uploads) finish so it
+          # doesn't overlap the next scenario
+          time.sleep(args.settle)
+  finally:
+    server.close()
+
+def get_backend_config(backend: str, args: argparse.Namespace,
+                       stand_ins: list[Any]) -> dict[str, str]:
+  """ Start the stand-in for a backend and return the app config to use it. """
+  if backend == 'LOCAL':
+    return {'STORAGE_SERVICE': 'LOCAL'}
+
+  if backend == 'S3':
+    stand_in: Any = MotoS3()
+  else:
+    if not args.gcs_endpoint:
+      raise ValueError('--gcs-endpoint is required for the GCS backend')
+    stand_in = FakeGcs(args.gcs_endpoint)
+  stand_ins.append(stand_in)
+
+  config = stand_in.get_config()
+  if args.local_cache:
+    config['STORAGE_CLOUD_LOCAL_CACHE'] = 'true'
+  return config
+
+def parse_args() -> argparse.Namespace:
+  """ Parse command line arguments. """
+  def csv(value: str) -> list[str]:
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+  parser = argparse.ArgumentParser(description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+  parser.add_argument('--backends', type=csv, default=['LOCAL'],
+                      help=f'Comma-separated backends, from {BACKENDS}')
+  parser.add_argument('--scenarios', type=csv, default=list(SCENARIOS),
+                      help=f'Comma-separated scenarios, from {SCENARIOS}')
+  parser.add_argument('--concurrency', type=lambda value: [
+                        int(item) for item in csv(value)], default=[1, 4, 16],
+                      help='Comma-separated concurrency levels')
+  parser.add_argument('--sizes', type=csv, default=['320x240', '1280x800'],
+                      help='Comma-separated image sizes, as WIDTHxHEIGHT')
+  parser.add_argument('--requests', type=int, default=200,
+                      help='Measured requests per scenario')
+  parser.add_argument('--warmup', type=int, default=10,
+                      help='Unmeasured requests before each scenario')
+  parser.add_argument('--settle', type=float, default=1.0,
+                      help='Seconds to wait between scenarios')
+  parser.add_argument('--seed', type=int, default=0,
+                      help='Seed for generating image bytes')
+  parser.add_argument('--local-cache', action='store_true',
+                      help='Use the local cache with cloud backends')
+  parser.add_argument('--gcs-endpoint',
+                      help='URL of a fake-gcs-server, for the GCS backend')
+  parser.add_argument('--output', type=pathlib.Path,
+                      help='File to write JSON results to, instead of stdout')
+
+  args = parser.parse_args()
+  for name, values, allowed in (('backend', args.backends, BACKENDS),
+                                ('scenario', args.scenarios, SCENARIOS)):
+    for value in values:
+      if value not in allowed:
+        parser.error(f'{value} is not a valid {name}')
+  # Other scenarios use the uploaded images
+  args.scenarios = sorted(set(args.scenarios) | {'upload'},
+                          key=SCENARIOS.index)
+  return args
+
+def main() -> None:
+  """ Run the benchmarks and output the results. """
+  args = parse_args()
+  if args.serve:
+    serve()
+    return
+
+  report: dict[str, Any] = {
+    'started': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    'commit': get_git_commit(),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'cpus': os.cpu_count(),
+    'args': {key: value for key, value in vars(args).items()
+             if key not in ('serve', 'output')},
+    'results': [],
+  }
+
+  stand_ins: list[Any] = []
+  try:
+    for backend in args.backends:
+      config = get_backend_config(backend, args, stand_ins)
+      for result in run_backend(backend, config, args):
+        print(f'{result.backend} {result.scenario} {result.image_size} '
+              f'c={result.concurrency}: {result.throughput_rps} req/s, '
+              f'p50 {result.latency_ms["p50"]}ms, '
+              f'p99 {result.latency_ms["p99"]}ms', file=sys.stderr)
+        report['results'].append(dataclasses.asdict(result))
+  finally:
+    for stand_in in stand_ins:
+      stand_in.close()
+
+  output = json.dumps(report, indent=2)
+  if args.output:
+    args.output.write_text(output + '\n', encoding='utf-8')
+  else:
+    print(output)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,144 @@
+""" Microbenchmarks for reading Image rows from SQLite and serializing them.
+
+The current Image model is compared with a baseline copy of the previous
+dataclass-based model, which decoded annotations eagerly and serialized with
+dataclasses.asdict(). Results are written as JSON. Run from the server
+directory:
+
+  python bench/rows.py --rows 1000 --annotations 20
+"""
+import argparse
+import dataclasses
+import json
+import pathlib
+import sqlite3
+import sys
+import timeit
+from typing import Any, Callable, Optional
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+# pylint: disable=wrong-import-position
+from screen_server import models
+
+@dataclasses.dataclass
+class BaselineImage():
+  """ The previous Image model, as a baseline. """
+  image_id: str = ''
+  source_url: Optional[str] = None
+  user_id: str = ''
+  metadata: str = ''
+  annotations: list[models.Annotation] = dataclasses.field(
+      default_factory=list)
+  status: str = 'PUBLIC'
+  created: int = 0
+  updated: int = 0
+
+  @classmethod
+  def sqlite3_factory(cls, cursor: sqlite3.Cursor,
+                      row: tuple[Any, ...]) -> 'BaselineImage':
+    """ Factory method for SQLite to produce an Image instance. """
+    custom_fields = ['annotations']
+
+    fields = [column[0] for column in cursor.description]
+    row_dict = dict(list(zip(fields, row)))
+
+    ss = cls(**{key: value for key, value in row_dict.items()
+                  if key not in custom_fields and value is not None})
+
+    if row_dict.get('annotations'):
+      ss.annotations = json.loads(row_dict['annotations'])
+
+    return ss
+
+  def as_dict(self) -> dict[str, Any]:
+    """ Return Image as dict, for JSON purposes. """
+    return dataclasses.asdict(self)
+
+  def as_summary_dict(self) -> dict[str, Any]:
+    """ Return Image as dict without the annotations, for JSON listings. """
+    return {field: getattr(self, field) for field in models.SUMMARY_FIELDS}
+
+
+def make_db(rows: int, annotations: int) -> sqlite3.Connection:
+  """ Create an in-memory database of images with annotations. """
+  conn = sqlite3.connect(':memory:')
+  conn.executescript((pathlib.Path(__file__).resolve().parent.parent
+                      / 'schema.sql').read_text(encoding='ascii'))
+  annotation_json = json.dumps([
+      ['Box', {'start': ['P', [index, index]],
+               'last': ['P', [index + 50, index + 40]]}]
+      if index % 2 else
+      ['Text', {'start': ['P', [index, index]], 'text': f'Note {index}'}]
+      for index in range(annotations)])
+  conn.executemany(
+      'INSERT INTO images VALUES (?, ?, ?, ?, ?, ?, ?)',
+      [(f'{index:013d}', f'https://example.com/{index}', 'bench@example.com',
+        annotation_json, 'PUBLIC', 1700000000 + index, 1700000000 + index)
+       for index in range(rows)])
+  return conn
+
+def get_cases(conn: sqlite3.Connection) -> dict[str, Callable[[Any], Any]]:
+  """ Return the benchmark cases, each taking the model class. """
+  full_sql = 'SELECT * FROM images'
+  summary_sql = f'SELECT {", ".join(models.SUMMARY_FIELDS)} FROM images'
+
+  def fetch(model: Any, sql: str) -> list[Any]:
+    cur = conn.cursor()
+    cur.row_factory = model.sqlite3_factory
+    return cur.execute(sql).fetchall()
+
+  def serialize_full(model: Any) -> str:
+    images = fetch(model, full_sql)
+    if model is models.Image:
+      return f'[{", ".join(image.as_json() for image in images)}]'
+    return json.dumps([image.as_dict() for image in images])
+
+  return {
+    'fetch_full': lambda model: fetch(model, full_sql),
+    'fetch_summary': lambda model: fetch(model, summary_sql),
+    'fetch_serialize_full': serialize_full,
+    'fetch_serialize_summary': lambda model: json.dumps(
+        [image.as_summary_dict() for image in fetch(model, summary_sql)]),
+  }
+
+def main() -> None:
+  """ Run the benchmarks and output the results. """
+  parser = argparse.ArgumentParser(description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--rows', type=int, default=1000,
+                      help='Number of image rows')
+  parser.add_argument('--annotations', type=int, default=20,
+                      help='Number of annotations per image')
+  parser.add_argument('--repeat', type=int, default=5,
+                      help='Number of timing runs, of which the best is used')
+  parser.add_argument('--output', type=pathlib.Path,
+                      help='File to write JSON results to, instead of stdout')
+  args = parser.parse_args()
+
+  conn = make_db(args.rows, args.annotations)
+  results: list[dict[str, Any]] = []
+  for name, case in get_cases(conn).items():
+    timings: dict[str, float] = {}
+    for label, model in (('baseline', BaselineImage),
+                         ('current', models.Image)):
+      # Best of several runs, per row
+      timings[label] = min(timeit.repeat(lambda: case(model), number=1,
+                                         repeat=args.repeat)) / args.rows
+    results.append({
+      'case': name,
+      'baseline_us_per_row': round(timings['baseline'] * 1e6, 3),
+      'current_us_per_row': round(timings['current'] * 1e6, 3),
+      'speedup': round(timings['baseline'] / timings['current'], 2),
+    })
+    print(f'{name}: {results[-1]["speedup"]}x', file=sys.stderr)
+
+  output = json.dumps({'rows': args.rows, 'annotations': args.annotations,
+                       'results': results}, indent=2)
+  if args.output:
+    args.output.write_text(output + '\n', encoding='utf-8')
+  else:
+    print(output)
+
+if __name__ == '__main__':
+  main()
@@ -1,11 +1,13 @@
 #!/bin/bash
 
+# The schema only creates what's missing, so it's loaded on every start to
+# upgrade existing databases as well as create new ones
 if [ -f "$FLASK_DB_FILE" ]
 then
-	echo "SQLite database found at $FLASK_DB_FILE."
+	echo "SQLite database found at $FLASK_DB_FILE. Loading any new schema."
 else
   echo "SQLite database not found at $FLASK_DB_FILE. Creating and initializing."
-  python -m flask initdb
 fi
+python -m flask initdb
 
 exec "$@"
@@ -11,3 +11,37 @@ CREATE TABLE IF NOT EXISTS images (
 ) WITHOUT ROWID;
 
 CREATE INDEX IF NOT EXISTS images_by_user ON images (user_id, created);
+
+-- Search index of source URLs and the text of text annotations. The rowid is
+-- derived from the image_id (see utils.id_to_int()). The user_key is the hex
+-- of the user_id (see utils.make_user_key()), so that searches are limited to
+-- a user's images within the index.
+CREATE VIRTUAL TABLE IF NOT EXISTS images_search USING fts5(
+  image_id UNINDEXED,
+  user_key,
+  source_url,
+  annotation_text
+);
+
+-- Image files are stored once per distinct content, keyed by its SHA-256 hash
+-- (the blob_id), and shared by every image with that content. Images uploaded
+-- before deduplication have no blob and are stored by their image_id.
+CREATE TABLE IF NOT EXISTS blobs (
+  blob_id TEXT PRIMARY KEY,
+  refcount INTEGER NOT NULL,
+  created INTEGER
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS image_blobs (
+  image_id TEXT PRIMARY KEY,
+  blob_id TEXT NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS image_blobs_by_blob ON image_blobs (blob_id);
+
+-- The version (updated value) of each image's latest annotated render, so that
+-- renders of earlier versions can be deleted from storage
+CREATE TABLE IF NOT EXISTS renders (
+  image_id TEXT PRIMARY KEY,
+  updated INTEGER NOT NULL
+) WITHOUT ROWID;
@@ -0,0 +1,183 @@
+""" Bloom filter of strings, shared by processes through a memory-mapped file.
+"""
+import contextlib
+import hashlib
+import logging
+import math
+import mmap
+import os
+import pathlib
+import struct
+import threading
+from typing import (Callable, Collection, ContextManager, Iterable, Iterator,
+                    Optional)
+
+from screen_server import shared
+
+LOGGER = logging.getLogger(__name__)
+
+HEADER = struct.Struct('<4sQIQQB')
+""" Binary format of the file header: magic, number of bits, number of hashes,
+number of items the file was sized for, number of items added and whether the
+file has been replaced.
+"""
+MAGIC = b'SBF2'
+REPLACED_OFFSET = HEADER.size - 1
+
+def get_size(capacity: int, error_rate: float) -> tuple[int, int]:
+  """ Return the number of bits and hashes for a filter which holds capacity
+  items with (at most) the given false positive rate.
+  """
+  bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+  # Rounded up to whole bytes
+  bits = max(8, (bits + 7) // 8 * 8)
+  return bits, max(1, round(bits / capacity * math.log(2)))
+
+class BloomFilter():
+  """ Set of strings which can have false positives but no false negatives.
+  The filter is built from its source the first time it's used, unless another
+  process already did. It's rebuilt when the source has more items than were
+  added to it, e.g. if it was added to while the filter wasn't in use, and
+  resized when more items are added than it was sized for. Items must be added
+  before they can be found by other processes, and must be in the source by the
+  end of adding(), e.g. by committing the transaction inserting them.
+  """
+  # Lookups read the mapped file without locking. Adds and builds are serialized
+  # across processes by a lock file, since setting a bit rewrites its byte. The
+  # lock is held until added items are in the source, so that a build (which
+  # can't carry bits over to a different size) never leaves any out. A rebuilt
+  # file replaces the old one, which is flagged so that processes still using it
+  # switch to the new one.
+  def __init__(self, path: pathlib.Path, capacity: int, error_rate: float,
+               count_source: Callable[[], int],
+               read_source: Callable[[], Iterable[str]]):
+    self.path = path
+    self.capacity = capacity
+    self.error_rate = error_rate
+    self.count_source = count_source
+    self.read_source = read_source
+
+    self._lock = threading.Lock()
+    self._mmap: Optional[mmap.mmap] = None
+
+  def _file_lock(self) -> ContextManager[bool]:
+    """ Take the exclusive lock for changing the filter, across processes. """
+    return shared.file_lock(pathlib.Path(f'{self.path}.lock'))
+
+  @staticmethod
+  def _get_positions(item: str, bits: int, hashes: int) -> Iterator[int]:
+    """ Return the bit positions for an item, by double hashing. """
+    digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+    first, second = struct.unpack('<QQ', digest)
+    # An odd step visits distinct positions
+    second |= 1
+    return ((first + index * second) % bits for index in range(hashes))
+
+  def _read_header(self) -> Optional[tuple[int, int, int, int]]:
+    """ Return the bits, hashes, capacity and item count of a usable filter
+    file.
+    """
+    try:
+      with open(self.path, 'rb') as fobj:
+        header = fobj.read(HEADER.size)
+        size = os.fstat(fobj.fileno()).st_size
+    except FileNotFoundError:
+      return None
+
+    if len(header) < HEADER.size:
+      return None
+    magic, bits, hashes, capacity, count, replaced = HEADER.unpack(header)
+    if magic != MAGIC or replaced or size != HEADER.size + bits // 8:
+      return None
+    return bits, hashes, capacity, count
+
+  def _build(self, extra: int = 0) -> None:
+    """ Build a new filter file from the source, with room for extra items
+    which are about to be added, replacing any existing one.
+    Must be called with the file lock.
+    """
+    count = self.count_source() + extra
+    # Room is left for growth, rather than rebuilding on every startup
+    capacity = max(self.capacity, count * 2)
+    bits, hashes = get_size(capacity, self.error_rate)
+
+    data = bytearray(bits // 8)
+    added = 0
+    for item in self.read_source():
+      for position in self._get_positions(item, bits, hashes):
+        data[position >> 3] |= 1 << (position & 7)
+      added += 1
+
+    tmp_path = self.path.with_name(f'.{self.path.name}.tmp')
+    with open(tmp_path, 'wb') as fobj:
+      fobj.write(HEADER.pack(MAGIC, bits, hashes, capacity, added, 0))
+      fobj.write(data)
+
+    # Processes using the old file switch once they see it has been replaced
+    try:
+      with open(self.path, 'r+b') as fobj:
+        fobj.seek(REPLACED_OFFSET)
+        fobj.write(b'\x01')
+    except FileNotFoundError:
+      pass
+    os.replace(tmp_path, self.path)
+    LOGGER.info('Built filter of %d items, %d bytes', added, bits // 8)
+
+  def _open(self) -> mmap.mmap:
+    """ Map the filter file, building it first if necessary.
+    Must be called with the file lock.
+    """
+    header = self._read_header()
+    if (header is None or header[3] > header[2]
+        or header[3] < self.count_source()):
+      self._build()
+
+    with open(self.path, 'r+b') as fobj:
+      self._mmap = mmap.mmap(fobj.fileno(), 0)
+    return self._mmap
+
+  def _get_mmap(self) -> mmap.mmap:
+    """ Get the mapped filter file, opening it if necessary. """
+    mapped = self._mmap
+    if mapped is None or mapped[REPLACED_OFFSET]:
+      # Locks are taken in the same order as adding(), which holds the file lock
+      with self._file_lock(), self._lock:
+        if self._mmap is None or self._mmap[REPLACED_OFFSET]:
+          self._open()
+        mapped = self._mmap
+      assert mapped
+
+    return mapped
+
+  def __contains__(self, item: str) -> bool:
+    mapped = self._get_mmap()
+    # The size is read from the mapped file, since it's fixed for each file
+    _, bits, hashes, _, _, _ = HEADER.unpack_from(mapped)
+    return all(mapped[HEADER.size + (position >> 3)] & (1 << (position & 7))
+               for position in self._get_positions(item, bits, hashes))
+
+  @contextlib.contextmanager
+  def adding(self, items: Collection[str]) -> Iterator[None]:
+    """ Add items to the filter, in every process. The filter isn't rebuilt
+    until the block exits, so the items must be added to the source within it.
+    """
+    with self._file_lock():
+      with self._lock:
+        # The file might have been replaced since it was mapped
+        mapped = self._mmap
+        if mapped is None or mapped[REPLACED_OFFSET]:
+          mapped = self._open()
+
+        _, bits, hashes, capacity, count, _ = HEADER.unpack_from(mapped)
+        if count + len(items) > capacity:
+          self._build(len(items))
+          mapped = self._open()
+          _, bits, hashes, capacity, count, _ = HEADER.unpack_from(mapped)
+
+        for item in items:
+          for position in self._get_positions(item, bits, hashes):
+            mapped[HEADER.size + (position >> 3)] |= 1 << (position & 7)
+        HEADER.pack_into(mapped, 0, MAGIC, bits, hashes, capacity,
+                         count + len(items), 0)
+
+      yield
@@ -1,30 +1,161 @@
 """ SQLite3 database access for persistence of the Image model. """
+import contextlib
 import sqlite3
 import json
 import time
 import pathlib
-from typing import List, Optional
+from typing import Any, ContextManager, Iterator, List, Optional, Union
 
+from screen_server import bloom
+from screen_server import lru
+from screen_server import metrics
 from screen_server import models
+from screen_server import shared
+from screen_server import utils
+
+DEFAULT_PRAGMAS: dict[str, Union[str, int]] = {
+  'journal_mode': 'wal',
+  # NORMAL is durable in WAL mode except against power loss
+  'synchronous': 'normal',
+  # Negative values are KiB rather than pages
+  'cache_size': -16000,
+  'mmap_size': 256 * 1024 * 1024,
+  'busy_timeout': 5000,
+}
+""" Default pragmas for every connection, overridable by config. """
+
+IMAGE_SELECT = ('SELECT images.*, image_blobs.blob_id '
+                'FROM images LEFT JOIN image_blobs USING (image_id)')
+""" Query for full image rows, including the ID of the image's file. """
+
+MAX_PATCH_OPS = 100
+""" Maximum number of operations in a single patch_annotations() call. """
+
+class UpdateConflictError(Exception):
+  """ Raised when an image has changed since the version being updated. """
+  def __init__(self, updated: int):
+    super().__init__(f'Image was updated at {updated}')
+    self.updated = updated
 
 class Db():
   """ SQLite data access class. """
-  def __init__(self, db_path: str):
+  def __init__(self, db_path: str,
+               pragmas: Optional[dict[str, Union[str, int]]] = None,
+               cached_statements: int = 128,
+               image_cache: Optional[lru.LruCache[models.Image]] = None,
+               signal: Optional[lru.InvalidationSignal] = None,
+               id_filter: Optional[bloom.BloomFilter] = None):
     """ Open the SQLite connection and set defaults. """
-    self.conn = sqlite3.connect(db_path, isolation_level=None)
-    self.conn.execute('pragma journal_mode=wal;')
+    # The image cache is shared by connections in the process. The signal is
+    # used to invalidate the image cache in other processes. The ID filter is
+    # shared by all processes, and rules out most IDs which don't exist.
+    self.image_cache = image_cache
+    self.signal = signal
+    self.id_filter = id_filter
+
+    self.conn = sqlite3.connect(db_path, isolation_level=None,
+                                cached_statements=cached_statements)
+    for name, value in (pragmas or {'journal_mode': 'wal'}).items():
+      self.conn.execute(f'pragma {name}={value};')
     self.conn.row_factory = models.Image.sqlite3_factory
 
+  def release(self):
+    """ Return the connection to a clean state so it can be reused. """
+    if self.conn.in_transaction:
+      self.conn.rollback()
+
   def load_schema(self, schema_file: pathlib.Path):
-    """ Load schema into the database from the schema_file. """
+    """ Load schema into the database from the schema_file.
+    A search index from before searches were limited to a user's images is
+    replaced, and rebuilt.
+    """
+    columns = {row[1] for row in
+               self._execute_raw('PRAGMA table_info(images_search)')}
+    stale_index = bool(columns) and 'user_key' not in columns
+    if stale_index:
+      self.conn.execute('DROP TABLE images_search')
+
     self.conn.executescript(open(schema_file, 'r', encoding='ascii').read())
+    if stale_index:
+      self.rebuild_search_index()
 
   def close(self):
     """ Close the SQLite connection. """
     self.conn.close()
 
-  def insert_image(self, image: models.Image) -> None:
-    """ Insert an Image into the database. """
+  @contextlib.contextmanager
+  def _transaction(self, immediate: bool = False) -> Iterator[None]:
+    """ Run statements in a transaction, rolling back on any exception.
+    An immediate transaction takes the write lock at the start, which is needed
+    if the transaction reads before it writes.
+    """
+    self.conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+    try:
+      yield
+    except BaseException:
+      self.conn.rollback()
+      raise
+    self.conn.execute('COMMIT')
+
+  def _execute_raw(self, sql: str,
+                   params: tuple[Any, ...] = ()) -> sqlite3.Cursor:
+    """ Execute a statement whose rows are tuples rather than Images. """
+    cur = self.conn.cursor()
+    cur.row_factory = None
+    return cur.execute(sql, params)
+
+  def _index_image(self, image_id: str,
+                   annotation_text: Optional[str] = None) -> None:
+    """ Replace an image's row in the search index.
+    If annotation_text isn't provided then it's extracted from the annotations
+    stored in the database.
+    """
+    # The search table's rowid is derived from the image_id so that rows can
+    # be found without a full scan
+    rowid = utils.id_to_int(image_id)
+    self.conn.execute('DELETE FROM images_search WHERE rowid = ?', (rowid, ))
+
+    if annotation_text is None:
+      text_sql = ("(SELECT group_concat(json_extract(value, '$[1].text'), "
+                  "                     char(10)) "
+                  ' FROM json_each(images.annotations) '
+                  " WHERE json_type(value, '$[1].text') = 'text')")
+      params: tuple[Any, ...] = (rowid, image_id)
+    else:
+      text_sql = '?'
+      params = (rowid, annotation_text, image_id)
+
+    self.conn.execute('INSERT INTO images_search '
+                      '  (rowid, image_id, user_key, source_url, '
+                      '   annotation_text) '
+                      'SELECT ?, image_id, hex(user_id), source_url, '
+                      f'       {text_sql} '
+                      'FROM images '
+                      'WHERE image_id = ?', params)
+
+  def _invalidate_image(self, image_id: str) -> None:
+    """ Remove an image from the cache, in this and other processes. """
+    if self.image_cache:
+      self.image_cache.invalidate(image_id)
+    if self.signal:
+      self.signal.send(image_id)
+
+  def _check_signal(self) -> None:
+    """ Remove images which other processes changed from the cache. """
+    assert self.image_cache is not None
+    if not self.signal:
+      return
+
+    changed = self.signal.check()
+    if changed is None:
+      self.image_cache.clear()
+      return
+
+    for image_id in changed:
+      self.image_cache.invalidate(image_id)
+
+  def _insert_image(self, image: models.Image) -> None:
+    """ Insert an Image and index it. Must be called in a transaction. """
     sql = ('INSERT INTO images (image_id, source_url, user_id, '
                                 'created, updated) '
            'VALUES(?, ?, ?, ?, ?)')
@@ -34,29 +165,347 @@ class Db():
 
     self.conn.execute(sql, (image.image_id, image.source_url,
                             image.user_id, image.created, image.updated))
+    if image.blob_id:
+      self.conn.execute('INSERT INTO blobs (blob_id, refcount, created) '
+                        'VALUES (?, 1, ?) '
+                        'ON CONFLICT (blob_id) '
+                        'DO UPDATE SET refcount = refcount + 1',
+                        (image.blob_id, image.created))
+      self.conn.execute('INSERT INTO image_blobs (image_id, blob_id) '
+                        'VALUES (?, ?)', (image.image_id, image.blob_id))
+    self._index_image(image.image_id, image.annotation_text())
+
+  def _adding_ids(self, images: List[models.Image]) -> ContextManager[None]:
+    """ Add images to the ID filter, if any, for the duration of their insert.
+    They're added before the insert is committed, so that no process can find
+    an image but have it ruled out by the filter.
+    """
+    if self.id_filter is None:
+      return contextlib.nullcontext()
+    return self.id_filter.adding([image.image_id for image in images])
+
+  def _may_exist(self, image_id: str) -> bool:
+    """ Check the ID filter for whether an image might exist. """
+    if self.id_filter is None:
+      return True
+
+    exists = image_id in self.id_filter
+    metrics.count_cache_lookup('image_ids', exists)
+    return exists
+
+  @metrics.timed_db
+  def insert_image(self, image: models.Image) -> None:
+    """ Insert an Image into the database. """
+    # New images can't be cached, since missing images aren't, so nothing is
+    # invalidated
+    with self._adding_ids([image]), self._transaction():
+      self._insert_image(image)
 
+  @metrics.timed_db
+  def insert_images(self, images: List[models.Image]) -> None:
+    """ Insert several Images into the database in a single transaction. """
+    with self._adding_ids(images), self._transaction():
+      for image in images:
+        self._insert_image(image)
 
+  @metrics.timed_db
   def get_image(self, image_id: str) -> Optional[models.Image]:
-    """ Get Image record from the database and return an Image instance. """
-    sql = 'SELECT * FROM images WHERE image_id = ?'
+    """ Get Image record from the database and return an Image instance.
+    Images may come from a cache shared with other threads and must not be
+    modified.
+    """
+    generation = None
+    if self.image_cache is not None:
+      self._check_signal()
+
+      image = self.image_cache.get(image_id)
+      metrics.count_cache_lookup('images', image is not None)
+      if image:
+        return image
+      # An image changed by another thread while it's read isn't cached
+      generation = self.image_cache.generation
+
+    if not self._may_exist(image_id):
+      return None
+
+    sql = f'{IMAGE_SELECT} WHERE image_id = ?'
     cur = self.conn.execute(sql, (image_id, ))
-    return cur.fetchone()
+    image = cur.fetchone()
+
+    # Missing images aren't cached since they might be created by another
+    # process
+    if image and self.image_cache is not None:
+      self.image_cache.put(image_id, image, generation)
+
+    return image
+
+  @metrics.timed_db
+  def get_images(self, image_ids: List[str]) -> List[models.Image]:
+    """ Get Image records for several image_ids, in the order given.
+    Missing images are skipped. Images may come from a cache shared with other
+    threads and must not be modified.
+    """
+    found: dict[str, models.Image] = {}
+    generation = None
+    if self.image_cache is not None:
+      self._check_signal()
+      generation = self.image_cache.generation
+
+      for image_id in image_ids:
+        image = self.image_cache.get(image_id)
+        metrics.count_cache_lookup('images', image is not None)
+        if image:
+          found[image_id] = image
 
-  def get_images_by_user(self, user_id: str, limit: int = 20) -> List[str]:
-    """ Get most recent Image instances for a user. """
-    sql = f'SELECT * FROM images WHERE user_id = ? LIMIT {int(limit)}'
-    cur = self.conn.execute(sql, (user_id, ))
+    # Only the images which weren't cached are queried, in a single statement
+    missing = list({image_id for image_id in image_ids
+                    if image_id not in found and self._may_exist(image_id)})
+    if missing:
+      sql = (f'{IMAGE_SELECT} '
+             f'WHERE image_id IN ({", ".join("?" * len(missing))})')
+      images: List[models.Image] = self.conn.execute(sql, missing).fetchall()
+      for image in images:
+        found[image.image_id] = image
+        if self.image_cache is not None:
+          self.image_cache.put(image.image_id, image, generation)
+
+    return [found[image_id] for image_id in image_ids if image_id in found]
+
+  @metrics.timed_db
+  def get_existing_blobs(self, blob_ids: List[str]) -> set[str]:
+    """ Return which of the blob_ids are already stored. """
+    if not blob_ids:
+      return set()
+
+    sql = ('SELECT blob_id FROM blobs '
+           f'WHERE blob_id IN ({", ".join("?" * len(blob_ids))})')
+    return {row[0] for row in self._execute_raw(sql, tuple(blob_ids))}
+
+  @metrics.timed_db
+  def get_images_by_user(
+      self, user_id: str, limit: int = 20,
+      before: Optional[tuple[int, str]] = None) -> List[models.Image]:
+    """ Get most recent Image instances for a user, newest first.
+    Pages are fetched by keyset: before is the (created, image_id) of the last
+    image on the previous page. Annotations are not loaded.
+    """
+    # The images_by_user index includes the image_id primary key, so it
+    # satisfies both the ordering and the keyset condition
+    keyset = '  AND (created, image_id) < (?, ?) ' if before else ''
+    sql = (f'SELECT {", ".join(models.SUMMARY_FIELDS)} '
+           'FROM images '
+           'WHERE user_id = ? '
+           f'{keyset}'
+           'ORDER BY created DESC, image_id DESC '
+           'LIMIT ?')
+    cur = self.conn.execute(sql, (user_id, *(before or ()), int(limit)))
     return cur.fetchall()
 
+  @metrics.timed_db
   def update_image(self, image: models.Image, user_name: str) -> int:
     """ Update image row based on Image instance. """
+    # updated always increases, so it can be used as a version number
     sql = ('UPDATE images '
            'SET annotations = ?, '
-           'updated = ? '
+           'updated = MAX(?, updated + 1) '
            'WHERE image_id = ? '
            '  AND user_id = ?')
-    cur: sqlite3.Cursor = self.conn.execute(
-        sql, (json.dumps(image.annotations), int(time.time()),
-              image.image_id, user_name))
+    with self._transaction():
+      cur: sqlite3.Cursor = self.conn.execute(
+          sql, (image.annotations_json(), int(time.time()),
+                image.image_id, user_name))
+      if cur.rowcount:
+        self._index_image(image.image_id, image.annotation_text())
+    self._invalidate_image(image.image_id)
 
     return cur.rowcount
+
+  @metrics.timed_db
+  def patch_annotations(self, image_id: str, user_name: str, updated: int,
+                        ops: List[dict[str, Any]]) -> Optional[int]:
+    """ Apply append/replace/delete operations to an image's annotations.
+    The operations are only applied if the image hasn't been updated since
+    updated; otherwise UpdateConflictError is raised. Operations are applied
+    within SQLite, so the stored annotations are never decoded here. Returns
+    the new updated value, or None if the image doesn't exist or doesn't belong
+    to the user. Raises ValueError for invalid operations.
+    """
+    if len(ops) > MAX_PATCH_OPS:
+      raise ValueError(f'No more than {MAX_PATCH_OPS} operations are allowed')
+
+    with self._transaction(immediate=True):
+      row = self._execute_raw(
+          'SELECT user_id, updated, '
+          "       json_array_length(COALESCE(annotations, '[]')) "
+          'FROM images '
+          'WHERE image_id = ?', (image_id, )).fetchone()
+      if not row or row[0] != user_name:
+        return None
+      if row[1] != updated:
+        raise UpdateConflictError(row[1])
+
+      # Each operation wraps the expression for the previous ones
+      expr = "COALESCE(annotations, '[]')"
+      params: list[Any] = []
+      length: int = row[2]
+      for op in ops:
+        if not isinstance(op, dict):
+          raise ValueError(f'Invalid operation {op}')
+        kind = op.get('op')
+        if kind in ('replace', 'delete'):
+          index = op.get('index')
+          if not isinstance(index, int) or not 0 <= index < length:
+            raise ValueError(f'Invalid annotation index {index}')
+          params.append(f'$[{index}]')
+
+        if kind in ('append', 'replace'):
+          annotation = op.get('annotation')
+          if not (isinstance(annotation, list) and len(annotation) == 2
+                  and isinstance(annotation[0], str)
+                  and isinstance(annotation[1], dict)):
+            raise ValueError(f'Invalid annotation {annotation}')
+          params.append(json.dumps(annotation))
+
+        if kind == 'append':
+          expr = f"json_insert({expr}, '$[#]', json(?))"
+          length += 1
+        elif kind == 'replace':
+          expr = f'json_replace({expr}, ?, json(?))'
+        elif kind == 'delete':
+          expr = f'json_remove({expr}, ?)'
+          length -= 1
+        else:
+          raise ValueError(f'Invalid operation {kind}')
+
+      new_updated = max(int(time.time()), updated + 1)
+      self.conn.execute('UPDATE images '
+                        f'SET annotations = {expr}, '
+                        'updated = ? '
+                        'WHERE image_id = ?',
+                        (*params, new_updated, image_id))
+      self._index_image(image_id)
+    self._invalidate_image(image_id)
+
+    return new_updated
+
+  @metrics.timed_db
+  def record_render(self, image_id: str, updated: int) -> Optional[int]:
+    """ Record that an image's render of version updated has been stored.
+    Returns the version of a render which is now stale and should be deleted
+    (either the previous one, or this one if a later version was already
+    recorded), if any.
+    """
+    with self._transaction(immediate=True):
+      row = self._execute_raw('SELECT updated FROM renders WHERE image_id = ?',
+                              (image_id, )).fetchone()
+      if row and row[0] >= updated:
+        return updated if row[0] > updated else None
+
+      self.conn.execute('INSERT INTO renders (image_id, updated) '
+                        'VALUES (?, ?) '
+                        'ON CONFLICT (image_id) '
+                        'DO UPDATE SET updated = excluded.updated',
+                        (image_id, updated))
+
+    return row[0] if row else None
+
+  @metrics.timed_db
+  def search_images(self, user_id: str, query: str,
+                    limit: int = 20) -> List[models.Image]:
+    """ Search a user's images by source URL and annotation text, returning the
+    best matches. Annotations are not loaded.
+    """
+    words = utils.make_fts_query(query)
+    if not words:
+      return []
+
+    # The user is matched within the index, so that other users' images are
+    # never ranked. Words are only matched in the searchable columns.
+    match = (f'user_key : "{utils.make_user_key(user_id)}" '
+             f'AND {{source_url annotation_text}} : ({words})')
+
+    fields = ', '.join(f'images.{field}' for field in models.SUMMARY_FIELDS)
+    sql = (f'SELECT {fields} '
+           'FROM images_search '
+           'JOIN images ON images.image_id = images_search.image_id '
+           'WHERE images_search MATCH ? '
+           '  AND images.user_id = ? '
+           'ORDER BY images_search.rank '
+           'LIMIT ?')
+    cur = self.conn.execute(sql, (match, user_id, int(limit)))
+    return cur.fetchall()
+
+  def rebuild_search_index(self, batch_size: int = 1000) -> int:
+    """ Rebuild the search index from the images table.
+    Returns the number of images indexed.
+    """
+    self.conn.execute('DELETE FROM images_search')
+
+    count = 0
+    last_id = ''
+    while True:
+      cur = self.conn.execute('SELECT * FROM images '
+                              'WHERE image_id > ? '
+                              'ORDER BY image_id '
+                              'LIMIT ?', (last_id, batch_size))
+      images: List[models.Image] = cur.fetchall()
+      if not images:
+        return count
+
+      with self._transaction():
+        for image in images:
+          self._index_image(image.image_id, image.annotation_text())
+
+      count += len(images)
+      last_id = images[-1].image_id
+
+
+class DbPool():
+  """ Pool of Db instances, one per thread, which are reused across requests.
+  Connections are tied to the process which opened them so that a pool created
+  before a fork (e.g., gunicorn --preload) is safe to use in the children.
+  """
+  def __init__(self, config: dict[str, str]):
+    self.db_path = config['DB_FILE']
+    self.cached_statements = int(config.get('DB_STATEMENT_CACHE') or 128)
+
+    self.pragmas = dict(DEFAULT_PRAGMAS)
+    for name in ('synchronous', 'cache_size', 'mmap_size', 'busy_timeout'):
+      value = config.get(f'DB_{name.upper()}')
+      if value is not None:
+        self.pragmas[name] = value
+
+    self.image_cache: lru.LruCache[models.Image] = lru.LruCache(
+        int(config.get('DB_IMAGE_CACHE_SIZE', 10000)),
+        float(config.get('DB_IMAGE_CACHE_TTL') or 300), 'images')
+    self.signal = (lru.InvalidationSignal(
+                       pathlib.Path(f'{self.db_path}.invalidate'))
+                   if config.get('DB_IMAGE_CACHE_SIGNAL') else None)
+    self.id_filter = (bloom.BloomFilter(
+                          pathlib.Path(f'{self.db_path}.ids'),
+                          int(config.get('DB_ID_FILTER_CAPACITY') or 1000000),
+                          float(config.get('DB_ID_FILTER_ERROR_RATE') or 0.01),
+                          self._count_image_ids, self._read_image_ids)
+                      if config.get('DB_ID_FILTER') else None)
+
+    self._dbconns = shared.PerThread(self._connect)
+
+  def _connect(self) -> Db:
+    """ Open a Db instance which shares this pool's caches. """
+    return Db(self.db_path, self.pragmas, self.cached_statements,
+              self.image_cache, self.signal, self.id_filter)
+
+  def get(self) -> Db:
+    """ Get this thread's Db instance, opening a connection if necessary. """
+    return self._dbconns.get()
+
+  def _count_image_ids(self) -> int:
+    """ Count the images, for the ID filter. """
+    with contextlib.closing(sqlite3.connect(self.db_path)) as conn:
+      return conn.execute('SELECT COUNT(*) FROM images').fetchone()[0]
+
+  def _read_image_ids(self) -> Iterator[str]:
+    """ Read every image ID, for building the ID filter. """
+    with contextlib.closing(sqlite3.connect(self.db_path)) as conn:
+      for row in conn.execute('SELECT image_id FROM images'):
+        yield row[0]
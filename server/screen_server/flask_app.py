@@ -1,7 +1,9 @@
 """ Module to help setup the Flask app """
+import io
+import os
 import pathlib
 import re
-from typing import Any, Tuple, Union
+from typing import Any, Optional, Tuple, Union
 
 import flask
 import flask_oidc
@@ -32,9 +34,110 @@ def get_app(app_dir: pathlib.Path) -> flask.Flask:
 
   return app
 
-def get_oidc(app: flask.Flask) -> flask_oidc.OpenIDConnect:
-  """ Get an OIDC instance configured configured with the Flask app. """
-  return flask_oidc.OpenIDConnect(app)
+def get_oidc() -> flask_oidc.OpenIDConnect:
+  """ Get an OIDC instance, to be configured with init_app() once the Flask app
+  has been created.
+  """
+  return flask_oidc.OpenIDConnect()
+
+def json_response(body: str, status: int = 200) -> flask.Response:
+  """ Return a response with an already-encoded JSON body. """
+  return flask.Response(body, status=status, mimetype='application/json')
+
+
+def image_etag(image_id: str, variant: Optional[str] = None) -> str:
+  """ Return the (strong) ETag value for an image, or one of its variants. """
+  # Image bytes never change once uploaded, so the ID is a sufficient validator
+  return f'{image_id}_{variant}' if variant else image_id
+
+def is_etag_fresh(etag: str) -> bool:
+  """ Check whether the current request's If-None-Match matches the etag. """
+  return flask.request.if_none_match.contains(etag)
+
+def _get_file_size(fobj: io.IOBase) -> Optional[int]:
+  """ Return the size of a file-like object, or None if it can't be found. """
+  # Streams from remote storage services know their size
+  size = getattr(fobj, 'size', None)
+  if size is not None:
+    return size
+
+  if isinstance(fobj, io.BytesIO):
+    return fobj.getbuffer().nbytes
+
+  try:
+    return os.fstat(fobj.fileno()).st_size
+  except (AttributeError, OSError):
+    pass
+
+  if fobj.seekable():
+    size = fobj.seek(0, os.SEEK_END)
+    fobj.seek(0)
+    return size
+
+  return None
+
+def _set_image_cache_headers(resp: flask.Response, immutable: bool = True,
+                             max_age: Optional[int] = None) -> None:
+  """ Mark an image response as cacheable forever, until it changes or for
+  max_age seconds.
+  """
+  config = flask.current_app.config
+  if max_age is not None:
+    resp.cache_control.max_age = max_age
+    resp.cache_control.no_cache = None
+  elif immutable:
+    resp.cache_control.max_age = int(config.get('IMAGE_CACHE_MAX_AGE',
+                                                31536000))
+    resp.cache_control.immutable = True
+    resp.cache_control.no_cache = None
+  else:
+    # Mutable images can be cached but must be revalidated with their ETag
+    resp.cache_control.no_cache = True
+
+  # Images require a login, so shared caches shouldn't store them unless
+  # they're trusted to enforce authentication themselves
+  if config.get('IMAGE_CACHE_PUBLIC'):
+    resp.cache_control.public = True
+  else:
+    resp.cache_control.private = True
+
+def not_modified(etag: str, immutable: bool = True) -> flask.Response:
+  """ Return a 304 Not Modified response for an image. """
+  resp = flask.Response(status=304)
+  resp.set_etag(etag)
+  _set_image_cache_headers(resp, immutable)
+  return resp
+
+def redirect_to_image(url: str) -> flask.Response:
+  """ Redirect to a (short-lived) URL which serves the image directly. """
+  resp = flask.redirect(url, 302)
+  # Let the browser reuse the redirect for a while, but not beyond the lifetime
+  # of the URL
+  expiry = int(flask.current_app.config.get('STORAGE_SIGNED_URL_EXPIRY') or 300)
+  resp.cache_control.private = True
+  resp.cache_control.max_age = expiry // 2
+  return resp
+
+def send_image(fobj: io.IOBase, etag: Optional[str],
+               last_modified: Optional[int] = None, immutable: bool = True,
+               mimetype: str = 'image/png',
+               max_age: Optional[int] = None) -> flask.Response:
+  """ Send an image with caching headers and Range support. An image which is
+  only cached for max_age seconds should have no ETag, so that it's requested
+  again rather than revalidated.
+  """
+  resp = flask.send_file(fobj, mimetype=mimetype, conditional=False,
+                         etag=etag or False, last_modified=last_modified)
+  _set_image_cache_headers(resp, immutable, max_age)
+
+  # send_file() only knows the size of BytesIO objects, but a complete length
+  # is required for Range requests
+  size = _get_file_size(fobj)
+  if size is not None:
+    resp.content_length = size
+
+  return resp.make_conditional(flask.request.environ, accept_ranges=True,
+                               complete_length=size)
 
 
 class ImageIdConverter(werkzeug.routing.BaseConverter):
@@ -42,6 +145,8 @@ class ImageIdConverter(werkzeug.routing.BaseConverter):
   # Besides doing a bit of validation, the important feature is it will "reject"
   # a path if the paramter doesn't validate, which is useful since the image_id
   # is otherwise a universal-looking path
+  regex = r'[a-z2-7]{13}'
+
   def to_python(self, value: str) -> Any:
     if re.fullmatch(r'[a-z2-7]{13}', value):
       return value
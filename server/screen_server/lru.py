@@ -0,0 +1,160 @@
+""" Bounded, thread-safe LRU cache with per-entry time-to-live. """
+import collections
+import mmap
+import os
+import pathlib
+import struct
+import threading
+import time
+from typing import Generic, Hashable, Optional, TypeVar
+
+from screen_server import metrics
+from screen_server import shared
+
+V = TypeVar('V')
+
+COUNTER = struct.Struct('<Q')
+""" Binary format of the counter in an InvalidationSignal file. """
+
+KEY = struct.Struct('32s')
+""" Binary format of each key in an InvalidationSignal file. """
+
+RING_SIZE = 256
+""" Number of recent keys kept in an InvalidationSignal file. """
+
+SIGNAL_SIZE = COUNTER.size + RING_SIZE * KEY.size
+
+class LruCache(Generic[V]):
+  """ LRU cache holding at most max_size entries, each for at most ttl secs.
+  Evictions are counted in the metrics under the cache's name, if it has one.
+  """
+  def __init__(self, max_size: int, ttl: float, name: Optional[str] = None):
+    self.max_size = max_size
+    self.ttl = ttl
+    self.name = name
+    # Incremented by every invalidation, so that a value read before one isn't
+    # added after it
+    self.generation = 0
+
+    self._lock = threading.Lock()
+    # Ordered from least to most recently used, with the time each expires
+    self._entries: collections.OrderedDict[Hashable, tuple[float, V]] = (
+        collections.OrderedDict())
+
+  def __len__(self) -> int:
+    return len(self._entries)
+
+  def get(self, key: Hashable) -> Optional[V]:
+    """ Get a value from the cache, or None if it's missing or expired. """
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None or entry[0] < time.monotonic():
+        if entry is not None:
+          del self._entries[key]
+        return None
+
+      self._entries.move_to_end(key)
+      return entry[1]
+
+  def put(self, key: Hashable, value: V,
+          generation: Optional[int] = None) -> None:
+    """ Add a value to the cache, evicting the least recently used entry.
+    If the generation from before the value was read is given, the value isn't
+    added if anything has been invalidated since, since it might be stale.
+    """
+    if self.max_size <= 0:
+      return
+
+    with self._lock:
+      if generation is not None and generation != self.generation:
+        return
+      self._entries[key] = (time.monotonic() + self.ttl, value)
+      self._entries.move_to_end(key)
+      evicted = max(0, len(self._entries) - self.max_size)
+      for _ in range(evicted):
+        self._entries.popitem(last=False)
+
+    if self.name:
+      for _ in range(evicted):
+        metrics.count_cache_eviction(self.name)
+
+  def invalidate(self, key: Hashable) -> None:
+    """ Remove a value from the cache. """
+    with self._lock:
+      self.generation += 1
+      self._entries.pop(key, None)
+
+  def clear(self) -> None:
+    """ Remove all values from the cache. """
+    with self._lock:
+      self.generation += 1
+      self._entries.clear()
+
+
+class InvalidationSignal():
+  """ File-based signal that keys in caches in other processes are stale.
+  The file holds a counter, which writers increment, followed by a ring of the
+  most recently sent keys. It is memory-mapped, so readers can cheaply check
+  whether it changed since they last looked, and which keys changed.
+  """
+  def __init__(self, path: pathlib.Path):
+    self.path = path
+
+    self._lock = threading.Lock()
+    self._mmap: Optional[mmap.mmap] = None
+    self._seen = 0
+
+  def _get_mmap(self) -> mmap.mmap:
+    """ Map the signal file into memory, creating it if necessary. """
+    # The file is opened lazily since its directory might not exist yet
+    if self._mmap is None:
+      with open(self.path, 'a+b') as fobj:
+        if os.fstat(fobj.fileno()).st_size < SIGNAL_SIZE:
+          fobj.truncate(SIGNAL_SIZE)
+        self._mmap = mmap.mmap(fobj.fileno(), SIGNAL_SIZE)
+      self._seen = COUNTER.unpack_from(self._mmap)[0]
+
+    return self._mmap
+
+  def send(self, key: str) -> None:
+    """ Signal other processes that a key is stale. """
+    with self._lock:
+      signal = self._get_mmap()
+
+    # Keys which don't fit are left blank, which invalidates everything
+    encoded = key.encode('utf-8')
+    if len(encoded) > KEY.size:
+      encoded = b''
+
+    with shared.file_lock(self.path):
+      counter = COUNTER.unpack_from(signal)[0]
+      # The key is written before the counter so that readers never see the
+      # counter without it
+      KEY.pack_into(signal, COUNTER.size + counter % RING_SIZE * KEY.size,
+                    encoded)
+      COUNTER.pack_into(signal, 0, counter + 1)
+
+  def check(self) -> Optional[list[str]]:
+    """ Return the keys which have been sent since the last check, or None if
+    too many were sent to know which (so that everything is stale).
+    """
+    # This process will see its own signals too, which is wasteful but avoids
+    # missing a signal sent by another process at the same time
+    with self._lock:
+      signal = self._get_mmap()
+      counter = COUNTER.unpack_from(signal)[0]
+      if counter == self._seen:
+        return []
+
+      keys: Optional[list[str]] = None
+      if counter - self._seen <= RING_SIZE:
+        keys = [KEY.unpack_from(signal, COUNTER.size + index % RING_SIZE
+                                * KEY.size)[0].rstrip(b'\0').decode('utf-8')
+                for index in range(self._seen, counter)]
+        # Keys might have been overwritten while they were read
+        if COUNTER.unpack_from(signal)[0] - self._seen > RING_SIZE or (
+            not all(keys)):
+          keys = None
+
+      self._seen = counter
+      return keys
@@ -0,0 +1,153 @@
+""" Prometheus metrics and Server-Timing measurements for the hot paths. """
+import collections
+import contextlib
+import contextvars
+import functools
+import os
+import time
+from typing import Any, Callable, Iterator, Optional, TypeVar, cast
+
+import prometheus_client
+from prometheus_client import core
+from prometheus_client import multiprocess
+
+# pyright: reportUnknownMemberType=false
+
+F = TypeVar('F', bound=Callable[..., Any])
+
+CONTENT_TYPE = prometheus_client.CONTENT_TYPE_LATEST
+
+DB_SECONDS = prometheus_client.Histogram(
+    'screen_db_seconds', 'Time spent in Db methods.', ['method'],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5))
+
+STORAGE_SECONDS = prometheus_client.Histogram(
+    'screen_storage_seconds',
+    'Time spent reading and writing files, by storage backend.',
+    ['backend', 'operation'],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+
+CACHE_LOOKUPS = prometheus_client.Counter(
+    'screen_cache_lookups', 'Cache lookups, by cache and result (hit or miss).',
+    ['cache', 'result'])
+
+CACHE_EVICTIONS = prometheus_client.Counter(
+    'screen_cache_evictions',
+    'Entries evicted from caches to stay within their limits, by cache.',
+    ['cache'])
+
+REPLICATIONS = prometheus_client.Counter(
+    'screen_replications',
+    'Attempts to replicate files to cloud storage in write-back mode, by '
+    'result.', ['result'])
+
+REQUEST_SECONDS = prometheus_client.Histogram(
+    'screen_request_seconds', 'Time spent handling requests, by endpoint.',
+    ['endpoint'])
+
+# Durations for the current request, by Server-Timing metric name. This is None
+# outside of requests, e.g. for background work.
+_timings: contextvars.ContextVar[Optional[dict[str, float]]] = (
+    contextvars.ContextVar('timings', default=None))
+
+@contextlib.contextmanager
+def _timer(histogram: Any, timing_name: str) -> Iterator[None]:
+  """ Observe the duration of the block, adding it to the request's timings. """
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    elapsed = time.perf_counter() - start
+    histogram.observe(elapsed)
+    timings = _timings.get()
+    if timings is not None:
+      timings[timing_name] += elapsed
+
+def timed_db(func: F) -> F:
+  """ Decorator to time a Db method. """
+  histogram = DB_SECONDS.labels(func.__name__)
+
+  @functools.wraps(func)
+  def wrapper(*args: Any, **kwargs: Any) -> Any:
+    with _timer(histogram, 'db'):
+      return func(*args, **kwargs)
+
+  return cast(F, wrapper)
+
+def timed_storage(operation: str) -> Callable[[F], F]:
+  """ Decorator to time a StorageService method, by the service's backend. """
+  def decorator(func: F) -> F:
+    @functools.wraps(func)
+    def wrapper(self: Any, *args: Any, **kwargs: Any) -> Any:
+      with _timer(STORAGE_SECONDS.labels(self.backend_name, operation),
+                  f'{self.backend_name}-{operation}'):
+        return func(self, *args, **kwargs)
+
+    return cast(F, wrapper)
+  return decorator
+
+def count_cache_lookup(cache: str, hit: bool) -> None:
+  """ Count a hit or miss for a cache. """
+  CACHE_LOOKUPS.labels(cache, 'hit' if hit else 'miss').inc()
+
+def count_cache_eviction(cache: str) -> None:
+  """ Count an entry evicted from a cache. """
+  CACHE_EVICTIONS.labels(cache).inc()
+
+def count_replication(success: bool) -> None:
+  """ Count an attempt to replicate a file to cloud storage. """
+  REPLICATIONS.labels('success' if success else 'failure').inc()
+
+def start_request() -> None:
+  """ Start collecting Server-Timing durations for the current request. """
+  _timings.set(collections.defaultdict(float))
+
+def get_server_timing(total: float) -> str:
+  """ Return a Server-Timing header value for the current request. """
+  timings = _timings.get() or {}
+  # Durations are in milliseconds
+  return ', '.join([f'{name};dur={seconds * 1000:.1f}'
+                    for name, seconds in sorted(timings.items())]
+                   + [f'total;dur={total * 1000:.1f}'])
+
+
+class _HitRatioCollector():
+  """ Collector of metrics with cache hit ratios, derived from the lookups. """
+  # Ratios are derived at scrape time, rather than being tracked as gauges, so
+  # that they're correct when aggregated across processes
+  def __init__(self, source: Any):
+    self.source = source
+
+  def collect(self) -> Iterator[Any]:
+    hits: collections.Counter[str] = collections.Counter()
+    lookups: collections.Counter[str] = collections.Counter()
+    for family in self.source.collect():
+      yield family
+      if family.name != 'screen_cache_lookups':
+        continue
+
+      for sample in family.samples:
+        if sample.name.endswith('_total'):
+          lookups[sample.labels['cache']] += sample.value
+          if sample.labels['result'] == 'hit':
+            hits[sample.labels['cache']] += sample.value
+
+    ratios = core.GaugeMetricFamily(
+        'screen_cache_hit_ratio', 'Ratio of cache lookups which were hits.',
+        labels=['cache'])
+    for cache, total in sorted(lookups.items()):
+      ratios.add_metric([cache], hits[cache] / total if total else 0.0)
+    yield ratios
+
+def generate_latest() -> bytes:
+  """ Return all metrics in the Prometheus text format. """
+  # In multiprocess mode (e.g., several gunicorn workers) each process writes
+  # its metrics to files which are aggregated when scraped
+  if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+    source: Any = prometheus_client.CollectorRegistry()
+    multiprocess.MultiProcessCollector(source)
+  else:
+    source = prometheus_client.REGISTRY
+
+  return prometheus_client.generate_latest(
+      cast(prometheus_client.CollectorRegistry, _HitRatioCollector(source)))
@@ -1,9 +1,10 @@
 """ Image model. """
-import dataclasses
+import functools
 import json
 import sqlite3
+import threading
 import time
-from typing import Any, Optional, Tuple, Union
+from typing import Any, Callable, Optional, Tuple, Union
 
 from screen_server import utils
 
@@ -14,35 +15,147 @@ def _timeint():
 Annotation = Tuple[str, dict[str, Union[str, Any]]]
 """ JSON-able representation of an Annotation. """
 
-@dataclasses.dataclass
+FIELDS = ('image_id', 'source_url', 'user_id', 'metadata', 'annotations',
+          'status', 'created', 'updated')
+""" Image fields, in the order they're serialized. """
+
+SUMMARY_FIELDS = ('image_id', 'source_url', 'user_id', 'status', 'created',
+                  'updated')
+""" Image fields included in listings, which exclude the annotations. """
+
+# Defaults for fields which are NULL or not selected, as values or factories
+_DEFAULTS: dict[str, Any] = {
+  'image_id': utils.make_id,
+  'source_url': None,
+  'user_id': '',
+  'metadata': '',
+  'status': 'PUBLIC',
+  'created': _timeint,
+  'updated': _timeint,
+  'blob_id': None,
+}
+
+# The row builder for the query most recently read by each thread. Queries
+# produce many rows, so this saves mapping the columns for every row.
+_last_row_builder = threading.local()
+
 class Image():
-  """ Image class. """
-  image_id: str = dataclasses.field(default_factory=utils.make_id)
-  source_url: Optional[str] = None
-  user_id: str = ''
-  metadata: str = ''
-  annotations: list[Annotation] = dataclasses.field(default_factory=list)
-  status: str = 'PUBLIC'
-  created: int = dataclasses.field(default_factory=_timeint)
-  updated: int = dataclasses.field(default_factory=_timeint)
+  """ Image class.
+  Annotations are kept as the JSON stored in the database until they're first
+  accessed, so rows which are only listed or serialized again are never
+  decoded. Images read from the database must not be modified in place.
+  """
+  __slots__ = ('image_id', 'source_url', 'user_id', 'metadata', 'status',
+               'created', 'updated', 'blob_id', '_annotations',
+               '_annotations_json')
 
-  @classmethod
-  def sqlite3_factory(cls, cursor: sqlite3.Cursor, row: tuple[str]) -> 'Image':
-    """ Factory method for SQLite to produce an Image instance. """
-    custom_fields = ['annotations']
+  def __init__(self, image_id: Optional[str] = None,
+               source_url: Optional[str] = None, user_id: str = '',
+               metadata: str = '',
+               annotations: Optional[list[Annotation]] = None,
+               status: str = 'PUBLIC', created: Optional[int] = None,
+               updated: Optional[int] = None, blob_id: Optional[str] = None):
+    self.image_id: str = image_id or utils.make_id()
+    self.source_url = source_url
+    self.user_id = user_id
+    self.metadata = metadata
+    self.status = status
+    self.created: int = _timeint() if created is None else created
+    self.updated: int = _timeint() if updated is None else updated
+    # Internal, so it isn't serialized
+    self.blob_id = blob_id
+    self._annotations: Optional[list[Annotation]] = (
+        [] if annotations is None else annotations)
+    self._annotations_json: Optional[str] = None
+
+  def __repr__(self) -> str:
+    return f'Image(image_id={self.image_id!r}, updated={self.updated!r})'
+
+  @property
+  def file_id(self) -> str:
+    """ ID of the image's file in storage. """
+    return self.blob_id or self.image_id
+
+  @property
+  def annotations(self) -> list[Annotation]:
+    """ The annotations, decoded from the stored JSON on first access. """
+    if self._annotations is None:
+      self._annotations = (json.loads(self._annotations_json)
+                           if self._annotations_json else [])
+    return self._annotations
 
-    fields = [column[0] for column in cursor.description]
-    row_dict = dict(list(zip(fields, row)))
+  @annotations.setter
+  def annotations(self, annotations: list[Annotation]) -> None:
+    self._annotations = annotations
+    self._annotations_json = None
 
-    ss = cls(**{key: value for key, value in row_dict.items()
-                  if key not in custom_fields and value is not None})
+  def annotations_json(self) -> str:
+    """ Return the annotations as JSON, without decoding them if possible. """
+    if self._annotations_json is not None:
+      return self._annotations_json
 
-    if row_dict.get('annotations'):
-      ss.annotations = json.loads(row_dict['annotations'])
+    return json.dumps(self.annotations)
 
-    return ss
+  @classmethod
+  def sqlite3_factory(cls, cursor: sqlite3.Cursor,
+                      row: tuple[Any, ...]) -> 'Image':
+    """ Factory method for SQLite to produce an Image instance. """
+    # The description is the same object for every row of a query
+    description = cursor.description
+    last = getattr(_last_row_builder, 'value', None)
+    if last is None or last[0] is not description:
+      last = _last_row_builder.value = (
+          description,
+          _get_row_builder(tuple(column[0] for column in description)))
+
+    return last[1](row)
+
+  def annotation_text(self) -> str:
+    """ Return the text of all text annotations, for search indexing. """
+    return '\n'.join(props['text'] for _, props in self.annotations
+                     if isinstance(props.get('text'), str))
 
   def as_dict(self) -> dict[str, Any]:
     """ Return Image as dict, for JSON purposes. """
-    return dataclasses.asdict(self)
+    return {field: getattr(self, field) for field in FIELDS}
+
+  def as_summary_dict(self) -> dict[str, Any]:
+    """ Return Image as dict without the annotations, for JSON listings. """
+    return {field: getattr(self, field) for field in SUMMARY_FIELDS}
+
+  def as_json(self) -> str:
+    """ Return Image as JSON, passing the stored annotations straight through.
+    """
+    fields = json.dumps({field: getattr(self, field) for field in FIELDS
+                         if field != 'annotations'})
+    return f'{fields[:-1]}, "annotations": {self.annotations_json()}}}'
+
+@functools.lru_cache(maxsize=64)
+def _get_row_builder(
+    columns: tuple[str, ...]) -> Callable[[tuple[Any, ...]], Image]:
+  """ Return a function which builds an Image from a row with these columns. """
+  indexes = [(index, column) for index, column in enumerate(columns)
+             if column in _DEFAULTS]
+  annotations_index = (columns.index('annotations')
+                       if 'annotations' in columns else None)
+  missing = [field for field in _DEFAULTS if field not in columns]
+
+  def build(row: tuple[Any, ...]) -> Image:
+    # __init__ is skipped since every attribute is set here
+    image = Image.__new__(Image)
+    for field in missing:
+      default = _DEFAULTS[field]
+      setattr(image, field, default() if callable(default) else default)
+    for index, field in indexes:
+      value = row[index]
+      if value is None:
+        default = _DEFAULTS[field]
+        value = default() if callable(default) else default
+      setattr(image, field, value)
+
+    image._annotations = None # pylint: disable=protected-access
+    image._annotations_json = ( # pylint: disable=protected-access
+        None if annotations_index is None else row[annotations_index])
+    return image
 
+  return build
@@ -0,0 +1,268 @@
+""" Server-side rendering of annotations onto images. """
+import concurrent.futures
+import functools
+import io
+import logging
+import math
+import threading
+from typing import Any, Callable, Optional
+
+from PIL import Image as PILImage
+from PIL import ImageDraw
+from PIL import ImageFont
+from werkzeug import datastructures
+
+from screen_server import models
+from screen_server.storage import singleflight
+from screen_server.storage import storage
+
+LOGGER = logging.getLogger(__name__)
+
+VARIANT = 'annotated'
+""" Name of the variant for images with their annotations drawn on them. """
+
+# Styles match the annotation classes in static/js/annotations/annotations.ts
+RED = (255, 0, 0, 255)
+WHITE = (255, 255, 255, 255)
+HIGHLIGHT = (255, 255, 0, 89)
+LINE_WIDTH = 2
+HIGHLIGHT_WIDTH = 15
+ARROW_HEAD_LENGTH = 15
+ARROW_HEAD_ANGLE = 35
+FONT_SIZE = 18
+BLUR_PIXEL_SIZE = 5
+
+Point = tuple[float, float]
+
+def _point(value: Any) -> Point:
+  """ Convert a JSON point, in the form ["P", [x, y]], to an (x, y) tuple. """
+  x, y = value[1]
+  x, y = float(x), float(y)
+  if not (math.isfinite(x) and math.isfinite(y)):
+    raise ValueError(f'Invalid point {value}')
+  return (x, y)
+
+def _clamp_points(props: dict[str, Any],
+                  size: tuple[int, int]) -> dict[str, Any]:
+  """ Return the properties with their points moved inside an image of the
+  given size, since boxes (e.g., blurred regions) are allocated in full.
+  """
+  clamped = dict(props)
+  for name in ('start', 'last'):
+    if name in props:
+      x, y = _point(props[name])
+      clamped[name] = ['P', [min(max(x, 0), size[0]), min(max(y, 0), size[1])]]
+  return clamped
+
+@functools.lru_cache(maxsize=1)
+def _get_font() -> ImageFont.ImageFont:
+  """ Get the font for text annotations, falling back to the default font. """
+  try:
+    return ImageFont.truetype('DejaVuSans.ttf', FONT_SIZE)
+  except OSError:
+    return ImageFont.load_default()
+
+def _draw_text(draw: ImageDraw.ImageDraw, props: dict[str, Any]) -> None:
+  """ Draw red text with a white outline, below and right of start. """
+  x, y = _point(props['start'])
+  font = _get_font()
+  if isinstance(font, ImageFont.FreeTypeFont):
+    # Canvas draws text from the baseline
+    draw.text((x, y + FONT_SIZE), props['text'], fill=RED, font=font,
+              anchor='ls', stroke_width=1, stroke_fill=WHITE)
+  else:
+    draw.text((x, y), props['text'], fill=RED, font=font)
+
+def _draw_line(draw: ImageDraw.ImageDraw, props: dict[str, Any]) -> None:
+  """ Draw a red line from start to last. """
+  draw.line([_point(props['start']), _point(props['last'])], fill=RED,
+            width=LINE_WIDTH)
+
+def _draw_arrow(draw: ImageDraw.ImageDraw, props: dict[str, Any]) -> None:
+  """ Draw a line with an arrowhead at the start. """
+  _draw_line(draw, props)
+
+  start, last = _point(props['start']), _point(props['last'])
+  line_angle = math.degrees(math.atan2(last[1] - start[1], last[0] - start[0]))
+  for angle in (-ARROW_HEAD_ANGLE, ARROW_HEAD_ANGLE):
+    radians = math.radians(line_angle + angle)
+    end = (round(math.cos(radians) * ARROW_HEAD_LENGTH + start[0]),
+           round(math.sin(radians) * ARROW_HEAD_LENGTH + start[1]))
+    draw.line([start, end], fill=RED, width=LINE_WIDTH)
+
+def _draw_highlight(draw: ImageDraw.ImageDraw, props: dict[str, Any]) -> None:
+  """ Draw a thick, translucent yellow line. """
+  draw.line([_point(props['start']), _point(props['last'])], fill=HIGHLIGHT,
+            width=HIGHLIGHT_WIDTH)
+
+def _box(props: dict[str, Any]) -> tuple[float, float, float, float]:
+  """ Return the (left, top, right, bottom) box between start and last. """
+  (x1, y1), (x2, y2) = _point(props['start']), _point(props['last'])
+  return (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+
+def _draw_box(draw: ImageDraw.ImageDraw, props: dict[str, Any]) -> None:
+  """ Draw a red rectangle. """
+  draw.rectangle(_box(props), outline=RED, width=LINE_WIDTH)
+
+def _draw_circle(draw: ImageDraw.ImageDraw, props: dict[str, Any]) -> None:
+  """ Draw a red circle (if snapped) or oval centered between start and last.
+  """
+  (x1, y1), (x2, y2) = _point(props['start']), _point(props['last'])
+  width, height = x2 - x1, y2 - y1
+  center_x, center_y = x1 + width / 2, y1 + height / 2
+  if props.get('lastSnap'):
+    radius_x = radius_y = abs(max(width, height) / 2)
+  else:
+    # The editor's oval expands beyond the cursor by the same factor
+    radius_x, radius_y = abs(width) * 0.7, abs(height) * 0.7
+
+  draw.ellipse((center_x - radius_x, center_y - radius_y,
+                center_x + radius_x, center_y + radius_y),
+               outline=RED, width=LINE_WIDTH)
+
+def _draw_blur(img: PILImage.Image, original: PILImage.Image,
+               props: dict[str, Any]) -> None:
+  """ Pixelate a box of the original image onto the image. """
+  box = tuple(int(round(coord)) for coord in _box(props))
+  region = original.crop(box)
+  if region.width and region.height:
+    small = region.resize((max(1, region.width // BLUR_PIXEL_SIZE),
+                           max(1, region.height // BLUR_PIXEL_SIZE)),
+                          PILImage.Resampling.BILINEAR)
+    img.paste(small.resize(region.size, PILImage.Resampling.NEAREST),
+              box[:2])
+
+DRAWERS: dict[str, Callable[[ImageDraw.ImageDraw, dict[str, Any]], None]] = {
+  'Text': _draw_text,
+  'Line': _draw_line,
+  'Arrow': _draw_arrow,
+  'Highlight': _draw_highlight,
+  'Box': _draw_box,
+  'Circle': _draw_circle,
+}
+""" Functions to draw each annotation type, other than Blur. """
+
+def render(fobj: io.IOBase, annotations: list[models.Annotation]) -> bytes:
+  """ Draw the annotations onto the image, in order, returning PNG bytes. """
+  original = PILImage.open(fobj)
+  original = original.convert(
+      'RGBA' if 'A' in original.getbands() else 'RGB')
+  img = original.copy()
+  # RGBA drawing blends translucent colors onto the image
+  draw = ImageDraw.Draw(img, 'RGBA')
+
+  for kind, props in annotations:
+    try:
+      props = _clamp_points(props, img.size)
+      if kind == 'Blur':
+        _draw_blur(img, original, props)
+      elif kind in DRAWERS:
+        DRAWERS[kind](draw, props)
+      else:
+        LOGGER.warning('Unable to render unknown annotation type %s', kind)
+    except (KeyError, IndexError, TypeError, ValueError):
+      LOGGER.warning('Unable to render invalid %s annotation', kind)
+
+  out = io.BytesIO()
+  img.save(out, format='PNG')
+  return out.getvalue()
+
+
+class RenderService():
+  """ Creates and reads images with their annotations drawn on them.
+  Renders are stored as variants keyed by the image's updated value, so a
+  render is never stale and repeated views are a single storage read. The
+  latest render's version is recorded (by record_render), and older renders
+  are deleted once a newer one is stored.
+  """
+  def __init__(self, config: dict[str, str], store: storage.StorageService,
+               get_image: Callable[[str], Optional[models.Image]],
+               record_render: Callable[[str, int], Optional[int]]):
+    self.storage = store
+    self.get_image = get_image
+    self.record_render = record_render
+    self.delay = float(config.get('RENDER_DELAY') or 5)
+    self.executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=int(config.get('RENDER_WORKERS') or 1),
+        thread_name_prefix='render')
+
+    self._flights: singleflight.SingleFlight[bytes] = (
+        singleflight.SingleFlight())
+    self._lock = threading.Lock()
+    self._timers: dict[str, threading.Timer] = {}
+
+  @classmethod
+  def _get_variant(cls, image: models.Image) -> str:
+    """ Return the storage variant name for the image's current version. """
+    return f'{VARIANT}_{image.updated}'
+
+  def _create(self, image: models.Image) -> bytes:
+    """ Render the image and save it to storage. """
+    with self.storage.read_file(image.file_id) as fobj:
+      data = render(fobj, image.annotations)
+
+    self.storage.write_file(image.image_id,
+                            datastructures.FileStorage(io.BytesIO(data)),
+                            self._get_variant(image))
+    LOGGER.debug('Rendered %s at %d', image.image_id, image.updated)
+
+    # The render has already been stored, so it's returned even if the stale
+    # render can't be deleted
+    try:
+      stale = self.record_render(image.image_id, image.updated)
+      if stale is not None:
+        self.storage.delete_file(image.image_id, f'{VARIANT}_{stale}')
+    except Exception: # pylint: disable=broad-except
+      LOGGER.exception('Unable to delete stale render of %s', image.image_id)
+
+    return data
+
+  def _render_latest(self, image_id: str) -> None:
+    """ Render the latest version of an image, if it isn't already. """
+    with self._lock:
+      self._timers.pop(image_id, None)
+
+    try:
+      image = self.get_image(image_id)
+      if not image or not image.annotations:
+        return
+
+      variant = self._get_variant(image)
+      try:
+        self.storage.read_file(image_id, variant).close()
+        return
+      except FileNotFoundError:
+        pass
+
+      self._flights.do(f'{image_id}_{variant}',
+                       functools.partial(self._create, image))
+    except Exception: # pylint: disable=broad-except
+      LOGGER.exception('Unable to render %s', image_id)
+
+  def submit(self, image_id: str) -> None:
+    """ Render an image in the background, once it has stopped changing. """
+    # Each edit restarts the delay, so a burst of edits is rendered once
+    timer = threading.Timer(self.delay, self.executor.submit,
+                            (self._render_latest, image_id))
+    timer.daemon = True
+    with self._lock:
+      old_timer = self._timers.get(image_id)
+      if old_timer:
+        old_timer.cancel()
+      self._timers[image_id] = timer
+    timer.start()
+
+  def read_file(self, image: models.Image) -> io.IOBase:
+    """ Read the rendered image, rendering it first if it doesn't exist. """
+    if not image.annotations:
+      return self.storage.read_file(image.file_id)
+
+    variant = self._get_variant(image)
+    try:
+      return self.storage.read_file(image.image_id, variant)
+    except FileNotFoundError:
+      pass
+
+    data = self._flights.do(f'{image.image_id}_{variant}',
+                            functools.partial(self._create, image))
+    return io.BytesIO(data)
@@ -0,0 +1,76 @@
+""" Backend services used by the app, created lazily in each process. """
+import os
+import threading
+from typing import Optional
+
+from screen_server import db
+from screen_server import render
+from screen_server import transcode
+from screen_server import variants
+from screen_server.storage import storage
+
+class Services():
+  """ The database pool, and the storage, variant, transcode and render
+  services.
+  Storage clients (e.g., boto3 sessions) and background threads can't be
+  shared across a fork, so each process creates its own services when it
+  first uses them. The storage backend's libraries are only imported then too.
+  The database pool is created up front since it's already per-process.
+  """
+  def __init__(self, config: dict[str, str]):
+    self.config = config
+    self.db_pool = db.DbPool(config)
+
+    self._lock = threading.Lock()
+    self._pid: Optional[int] = None
+    self._storage: Optional[storage.StorageService] = None
+    self._variants: Optional[variants.VariantService] = None
+    self._transcodes: Optional[transcode.TranscodeService] = None
+    self._renderer: Optional[render.RenderService] = None
+
+  def _ensure_created(self) -> None:
+    """ Create the services, if this process hasn't already. """
+    if self._pid == os.getpid():
+      return
+
+    with self._lock:
+      if self._pid != os.getpid():
+        store = storage.StorageService.get_instance(self.config)
+        self._variants = variants.VariantService(self.config, store)
+        self._transcodes = transcode.TranscodeService(self.config, store,
+                                                      self._variants)
+        self._renderer = render.RenderService(
+            self.config, store,
+            lambda image_id: self.db_pool.get().get_image(image_id),
+            lambda image_id, updated: self.db_pool.get().record_render(
+                image_id, updated))
+        self._storage = store
+        self._pid = os.getpid()
+
+  @property
+  def storage(self) -> storage.StorageService:
+    """ This process's storage service. """
+    self._ensure_created()
+    assert self._storage
+    return self._storage
+
+  @property
+  def variants(self) -> variants.VariantService:
+    """ This process's variant service. """
+    self._ensure_created()
+    assert self._variants
+    return self._variants
+
+  @property
+  def transcodes(self) -> transcode.TranscodeService:
+    """ This process's transcode service. """
+    self._ensure_created()
+    assert self._transcodes
+    return self._transcodes
+
+  @property
+  def renderer(self) -> render.RenderService:
+    """ This process's render service. """
+    self._ensure_created()
+    assert self._renderer
+    return self._renderer
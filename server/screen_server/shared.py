@@ -0,0 +1,68 @@
+""" Locks and per-thread state which are safe to use across processes,
+including processes forked from a preloaded app (e.g., gunicorn --preload).
+"""
+import contextlib
+import fcntl
+import os
+import pathlib
+import threading
+import zlib
+from typing import (Callable, ContextManager, Generic, Iterator, Optional,
+                    TypeVar)
+
+T = TypeVar('T')
+
+# Number of lock files used for striped locks. Keys are hashed onto a fixed set
+# of files so that lock files don't accumulate forever.
+LOCK_STRIPES = 256
+
+@contextlib.contextmanager
+def file_lock(path: pathlib.Path, blocking: bool = True) -> Iterator[bool]:
+  """ Take an exclusive lock on a file, across processes.
+  Yields whether the lock was taken without waiting for another holder. If
+  blocking is false then the lock isn't waited for, and isn't held if False is
+  yielded.
+  """
+  with open(path, 'a+b') as lock_file:
+    try:
+      fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      immediate = True
+    except BlockingIOError:
+      if not blocking:
+        yield False
+        return
+      fcntl.flock(lock_file, fcntl.LOCK_EX)
+      immediate = False
+
+    try:
+      yield immediate
+    finally:
+      fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def striped_lock(lock_dir: pathlib.Path, key: str,
+                 blocking: bool = True) -> ContextManager[bool]:
+  """ Take the lock file in lock_dir which the key hashes to, as file_lock().
+  """
+  stripe = zlib.crc32(key.encode('utf-8')) % LOCK_STRIPES
+  return file_lock(lock_dir / f'{stripe:03d}.lock', blocking)
+
+
+class PerThread(Generic[T]):
+  """ A value (e.g., an SQLite connection) created for each thread on first use.
+  Values are tied to the process which created them, so a child of a fork
+  creates its own rather than using its parent's.
+  """
+  def __init__(self, create: Callable[[], T]):
+    self.create = create
+    self._local = threading.local()
+
+  def get(self) -> T:
+    """ Get this thread's value, creating it if necessary. """
+    value: Optional[T] = getattr(self._local, 'value', None)
+    # Connections must not be used across a fork. The parent's value isn't
+    # closed since that could affect the parent's use of it.
+    if value is None or self._local.pid != os.getpid():
+      value = self._local.value = self.create()
+      self._local.pid = os.getpid()
+
+    return value
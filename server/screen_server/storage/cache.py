@@ -0,0 +1,254 @@
+""" Size-bounded local filesystem cache for cloud StorageServices. """
+# pyright: reportImportCycles=false
+from __future__ import annotations
+import collections
+import dataclasses
+import io
+import logging
+import os
+import pathlib
+import threading
+import time
+from typing import Optional, Union
+
+from werkzeug import datastructures
+
+from screen_server import metrics
+from screen_server.storage import local
+
+LOGGER = logging.getLogger(__name__)
+
+POLICIES = ('LRU', 'LFU')
+
+RECENCY_SECONDS = 60
+""" How stale a file's recorded recency (its mtime) may be before a read
+updates it. """
+
+@dataclasses.dataclass
+class _CacheEntry():
+  """ Bookkeeping for a single cached file. """
+  size: int
+  hits: int = 0
+  # When the file's recency was last recorded on disk (its mtime)
+  mtime: float = 0.0
+
+
+class LocalCacheStorageService(local.LocalFileSystemStorageService):
+  """ Local filesystem storage which evicts files to stay within limits. """
+  # Each process keeps its own index of the cached files. Recency is also
+  # recorded on disk (via the file mtime) so that the index can be recovered on
+  # startup, and so that periodic rescans pick up files written and evicted by
+  # other processes sharing the same directory.
+  # Reads and writes are timed by the (inherited) filesystem methods, under
+  # this backend name.
+  backend_name = 'cache'
+
+  def __init__(self, config: dict[str, str]):
+    super().__init__(config)
+
+    self.max_bytes = int(config.get('STORAGE_CLOUD_LOCAL_CACHE_MAX_BYTES')
+                         or 0)
+    self.max_entries = int(config.get('STORAGE_CLOUD_LOCAL_CACHE_MAX_FILES')
+                           or 0)
+    self.policy = str(config.get('STORAGE_CLOUD_LOCAL_CACHE_POLICY')
+                      or 'LRU').upper()
+    self.rescan_interval = int(
+        config.get('STORAGE_CLOUD_LOCAL_CACHE_RESCAN_SECONDS') or 300)
+
+    if self.policy not in POLICIES:
+      raise ValueError(f'{self.policy} is not a valid cache eviction policy')
+
+    self.total_files = 0
+    self.total_bytes = 0
+    self._lock = threading.Lock()
+    # Ordered from least to most recently used
+    self._entries: collections.OrderedDict[pathlib.Path, _CacheEntry] = (
+        collections.OrderedDict())
+    # For LFU, files by their number of hits, each in LRU order, so that the
+    # victim is found without searching every entry
+    self._by_hits: dict[int, collections.OrderedDict[pathlib.Path, None]] = {}
+    self._min_hits = 0
+    self._last_scan = 0.0
+
+    self._scan()
+
+  def _scan(self) -> None:
+    """ Rebuild the index (and the size) from the directory tree. """
+    found: list[tuple[float, pathlib.Path, int]] = []
+    for dirpath, dirnames, filenames in os.walk(self.root_directory):
+      # Skip lock files and temporary files, which are all dot-prefixed
+      dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+      for filename in filenames:
+        if filename.startswith('.'):
+          continue
+        path = pathlib.Path(dirpath) / filename
+        try:
+          stat = path.stat()
+        except FileNotFoundError:
+          continue
+        found.append((stat.st_mtime, path, stat.st_size))
+
+    found.sort()
+    with self._lock:
+      old_entries = self._entries
+      self._entries = collections.OrderedDict()
+      self._by_hits = {}
+      self._min_hits = 0
+      self.total_files = 0
+      self.total_bytes = 0
+      for mtime, path, size in found:
+        old_entry = old_entries.get(path)
+        self._add_entry(path, size, old_entry.hits if old_entry else 0, mtime)
+      self._last_scan = time.monotonic()
+
+    LOGGER.info('Local cache holds %d files totalling %d bytes',
+                self.total_files, self.total_bytes)
+    self._evict()
+
+  def _maybe_rescan(self) -> None:
+    """ Rescan the directory tree in the background, if the index hasn't been
+    recently synced.
+    """
+    now = time.monotonic()
+    with self._lock:
+      if now - self._last_scan <= self.rescan_interval:
+        return
+      # Claimed before scanning so that concurrent reads don't scan too
+      self._last_scan = now
+
+    threading.Thread(target=self._scan, daemon=True,
+                     name='cache-rescan').start()
+
+  def _over_limit(self) -> bool:
+    """ Check whether the cache has exceeded its configured limits. """
+    return bool((self.max_bytes and self.total_bytes > self.max_bytes)
+                or (self.max_entries and self.total_files > self.max_entries))
+
+  def _pick_victim(self) -> pathlib.Path:
+    """ Choose which file to evict, based on the eviction policy. """
+    if self.policy == 'LFU':
+      # Ties are broken by recency since each bucket is in LRU order
+      return next(iter(self._by_hits[self._min_hits]))
+
+    return next(iter(self._entries))
+
+  def _bucket_add(self, path: pathlib.Path, hits: int) -> None:
+    """ Add a file to the LFU bucket for its hits. Must be called with the lock.
+    """
+    if self.policy != 'LFU':
+      return
+
+    if not self._by_hits or hits < self._min_hits:
+      self._min_hits = hits
+    self._by_hits.setdefault(hits, collections.OrderedDict())[path] = None
+
+  def _bucket_remove(self, path: pathlib.Path, hits: int) -> None:
+    """ Remove a file from its LFU bucket. Must be called with the lock. """
+    if self.policy != 'LFU':
+      return
+
+    bucket = self._by_hits[hits]
+    del bucket[path]
+    if not bucket:
+      del self._by_hits[hits]
+      # Only the (few) distinct hit counts are searched, and only when the
+      # least frequent bucket empties
+      if hits == self._min_hits and self._by_hits:
+        self._min_hits = min(self._by_hits)
+
+  def _evict(self) -> None:
+    """ Delete files until the cache is within its limits. """
+    victims: list[pathlib.Path] = []
+    with self._lock:
+      while self._entries and self._over_limit():
+        path = self._pick_victim()
+        self._remove_entry(path)
+        victims.append(path)
+
+    for path in victims:
+      path.unlink(missing_ok=True)
+      metrics.count_cache_eviction('local')
+
+  def _add_entry(self, path: pathlib.Path, size: int, hits: int = 0,
+                 mtime: float = 0.0) -> _CacheEntry:
+    """ Add (or replace) a file in the index. Must be called with the lock. """
+    self._remove_entry(path)
+
+    entry = self._entries[path] = _CacheEntry(size, hits, mtime)
+    self._bucket_add(path, hits)
+    self.total_files += 1
+    self.total_bytes += size
+    return entry
+
+  def _remove_entry(self, path: pathlib.Path) -> None:
+    """ Remove a file from the index. Must be called with the lock. """
+    entry = self._entries.pop(path, None)
+    if entry:
+      self._bucket_remove(path, entry.hits)
+      self.total_files -= 1
+      self.total_bytes -= entry.size
+
+  def _touch_entry(self, path: pathlib.Path, entry: _CacheEntry) -> None:
+    """ Record a hit on a file in the index. Must be called with the lock. """
+    self._bucket_remove(path, entry.hits)
+    entry.hits += 1
+    self._bucket_add(path, entry.hits)
+    self._entries.move_to_end(path)
+
+  def write_file(self, file_id: str,
+      fdata: Union[datastructures.FileStorage, io.IOBase],
+      variant: Optional[str] = None) -> None:
+    super().write_file(file_id, fdata, variant)
+
+    path = self._get_filepath(file_id, variant)
+    stat = path.stat()
+    with self._lock:
+      self._add_entry(path, stat.st_size, mtime=stat.st_mtime)
+
+    self._evict()
+
+  def delete_file(self, file_id: str, variant: Optional[str] = None) -> None:
+    super().delete_file(file_id, variant)
+    with self._lock:
+      self._remove_entry(self._get_filepath(file_id, variant))
+
+  def read_file(self, file_id: str,
+      variant: Optional[str] = None) -> io.IOBase:
+    self._maybe_rescan()
+    path = self._get_filepath(file_id, variant)
+
+    try:
+      fobj = super().read_file(file_id, variant)
+    except FileNotFoundError:
+      metrics.count_cache_lookup('local', False)
+      with self._lock:
+        # Another process might have evicted the file
+        self._remove_entry(path)
+      raise
+
+    metrics.count_cache_lookup('local', True)
+    now = time.time()
+    with self._lock:
+      entry = self._entries.get(path)
+      # Another process might have written the file since the last scan
+      is_new = entry is None
+      if entry is None:
+        stat = os.fstat(fobj.fileno())
+        entry = self._add_entry(path, stat.st_size, mtime=stat.st_mtime)
+      self._touch_entry(path, entry)
+      # Recency is recorded on disk so it survives restarts and is seen by
+      # rescans, but only occasionally, rather than writing on every read
+      update_mtime = now - entry.mtime > RECENCY_SECONDS
+      if update_mtime:
+        entry.mtime = now
+
+    if update_mtime:
+      try:
+        os.utime(path, (now, now))
+      except FileNotFoundError:
+        pass
+
+    if is_new:
+      self._evict()
+
+    return fobj
@@ -1,55 +1,81 @@
 """ StorageService for reading/writing images in GCS buckets. """
 # pyright: reportImportCycles=false, reportMissingTypeStubs=false
 # pyright: reportUnknownMemberType=false
-import io
+import datetime
+import math
 from typing import Optional
 
+from google.api_core import exceptions
+from google.auth import credentials
 from google.cloud import storage as gstore
 from google.oauth2 import service_account
 from werkzeug import datastructures
 
+from screen_server import metrics
 from screen_server.storage import storage
 
-class GcsStorageService(storage.StorageService):
+GCS_CHUNK_MULTIPLE = 256 * 1024
+
+class GcsStorageService(storage.CloudStorageService):
   """ StorageService for reading/writing images in GCS. """
+  backend_name = 'gcs'
+
   def __init__(self, config: dict[str, str],
                local_cache: Optional[storage.StorageService]):
     """ Create GCS session. """
     super().__init__(config, local_cache)
 
-    creds = service_account.Credentials.from_service_account_file(
-        config['STORAGE_GCS_SAKE'])
+    endpoint_url = config.get('STORAGE_GCS_ENDPOINT_URL')
+    if endpoint_url:
+      # GCS-compatible emulators, e.g. fake-gcs-server, don't check credentials
+      client = gstore.Client(
+          project='screen', credentials=credentials.AnonymousCredentials(),
+          client_options={'api_endpoint': endpoint_url})
+    else:
+      creds = service_account.Credentials.from_service_account_file(
+          config['STORAGE_GCS_SAKE'])
+      client = gstore.Client(credentials=creds)
 
-    client = gstore.Client(credentials=creds)
     self.bucket = client.bucket(config['STORAGE_GCS_BUCKET'])
 
-  def write_file(self, file_id: str, fdata: datastructures.FileStorage,
-      variant: Optional[str] = None) -> None:
-    """Put image in GCS bucket and possibly save a cache locally. """
-    blob = self.bucket.blob(self._get_filename(file_id, variant))
-    blob.upload_from_file(fdata)
-
-    # If local_cache is defined then also save to filesystem
-    self._maybe_cache_locally(file_id, fdata, variant)
-
-  def read_file(self, file_id: str, variant: Optional[str] = None) -> io.IOBase:
-    """ Read file from possible local cache and GCS bucket. """
-    # If local cache has been set up then try to read file from there first
-    if self.local_cache:
-      try:
-        return self.local_cache.read_file(file_id, variant)
-      except FileNotFoundError:
-        pass
-
-    # File not available locally -- get from GCS
-    fdata = io.BytesIO()
+  @metrics.timed_storage('write')
+  def _write_remote(self, file_id: str, fdata: datastructures.FileStorage,
+                    variant: Optional[str] = None) -> None:
+    """ Put image in GCS bucket. """
     blob = self.bucket.blob(self._get_filename(file_id, variant))
-    fdata.write(blob.download_as_bytes())
-    fdata.seek(0)
-    #name = self._get_filename(file_id, variant)
+    if self.memory_bounded:
+      # Chunked (resumable) uploads only buffer one chunk at a time. Chunk size
+      # must be a multiple of 256KB.
+      chunks = max(1, math.ceil(self.chunk_size / GCS_CHUNK_MULTIPLE))
+      blob.chunk_size = chunks * GCS_CHUNK_MULTIPLE
+    # The upload is streamed from the request
+    blob.upload_from_file(fdata.stream, rewind=True,
+                          content_type=self.get_content_type(variant))
 
-    #self.bucket.download_fileobj(name, fdata)
+  @metrics.timed_storage('open')
+  def _open_remote(self, file_id: str,
+                   variant: Optional[str] = None) -> storage.RemoteFile:
+    """ Open streaming download of file from GCS bucket. """
+    name = self._get_filename(file_id, variant)
+    blob = self.bucket.get_blob(name)
+    if blob is None:
+      raise FileNotFoundError(name)
 
-    self._maybe_cache_locally(file_id, fdata, variant)
+    return storage.RemoteFile(blob.open('rb', chunk_size=self.chunk_size),
+                              blob.size)
 
-    return fdata
+  @metrics.timed_storage('delete')
+  def _delete_remote(self, file_id: str,
+                     variant: Optional[str] = None) -> None:
+    """ Delete file from GCS bucket. """
+    try:
+      self.bucket.blob(self._get_filename(file_id, variant)).delete()
+    except exceptions.NotFound:
+      pass
+
+  def _sign_url(self, file_id: str, variant: Optional[str] = None) -> str:
+    """ Generate a pre-signed URL to read the file from the GCS bucket. """
+    blob = self.bucket.blob(self._get_filename(file_id, variant))
+    return blob.generate_signed_url(
+        version='v4', method='GET',
+        expiration=datetime.timedelta(seconds=self.signed_url_expiry))
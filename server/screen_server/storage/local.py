@@ -1,29 +1,31 @@
 """ StorageService for reading/writing images in local filesystem. """
 # pyright: reportImportCycles=false
 import io
+import os
 import pathlib
+import shutil
+import tempfile
 from typing import Optional, Union
 
 from werkzeug import datastructures
 
+from screen_server import metrics
 from screen_server.storage import storage
 
 class LocalFileSystemStorageService(storage.StorageService):
   """ Storage within the local filesystem. """
-  # TODO: Make this multi-processor safe using something like fasteners.
-  # Currently it's possible that two processes (or threads) might try to write
-  # to the file at the same time, or read from the file while it's being
-  # written to. This is far more likely when this class is used as a local
-  # cache for a cloud-based service. E.g., two requests for the same image are
-  # made, both of which find no local cache, download the image, and then begin
-  # writing at about the same time. Or one that reads while the image is being
-  # written. These race conditions are highly unlikely, but should be
-  # considered.
-  def __init__(self, config: dict[str, str]):
+  # Files are written to a temporary file and then renamed into place, so
+  # readers (in any process) will never see a partially-written file.
+  backend_name = 'local'
+
+  def __init__(self, config: dict[str, str], durable: bool = False):
     super().__init__(config)
+    # Durable writes are synced to disk before write_file() returns
+    self.durable = durable
 
     self.root_directory = pathlib.Path(config['STORAGE_LOCAL_DIR'])
     self.root_directory.mkdir(exist_ok=True, parents=True)
+    self.lock_directory = self.root_directory / '.locks'
 
   def _get_filepath(self, file_id: str,
                     variant: Optional[str] = None) -> pathlib.Path:
@@ -31,23 +33,53 @@ class LocalFileSystemStorageService(storage.StorageService):
     # first half are randomly generated while the last half is a timestamp which
     # effectively means that first half of that is going to represent the
     # "years" while the last half will be somewhat well distributed over time.
-    # Filenames are base32, so 1024 possibilities per 2 characters.
-    sharded_dir = self.root_directory / file_id[-6:-4] / file_id[0]
-    sharded_dir.mkdir(exist_ok=True, parents=True)
-    return sharded_dir / self._get_filename(file_id, variant)
+    # Filenames are base32, so 1024 possibilities per 2 characters. Content
+    # hashes (see utils.hash_file()) are uniformly distributed throughout.
+    # Directories are created when writing, rather than on every read
+    return (self.root_directory / file_id[-6:-4] / file_id[0]
+            / self._get_filename(file_id, variant))
 
+  @metrics.timed_storage('write')
   def write_file(self, file_id: str,
-      fdata: Union[datastructures.FileStorage, io.BytesIO],
+      fdata: Union[datastructures.FileStorage, io.IOBase],
       variant: Optional[str] = None) -> None:
     name = self._get_filepath(file_id, variant)
+    name.parent.mkdir(exist_ok=True, parents=True)
+
+    # Temporary files are dot-prefixed so they can be ignored by directory scans
+    tmp_fd, tmp_name = tempfile.mkstemp(dir=name.parent,
+                                        prefix=f'.{name.name}.', suffix='.tmp')
+    try:
+      # mkstemp() creates owner-only files
+      os.fchmod(tmp_fd, 0o644)
+      with os.fdopen(tmp_fd, 'wb') as fobj:
+        # Werkzeug FileStorage can only (easily) be saved with .save()
+        if isinstance(fdata, datastructures.FileStorage):
+          fdata.save(fobj) # pyright: reportUnknownMemberType=false
+        else:
+          shutil.copyfileobj(fdata, fobj)
+        if self.durable:
+          fobj.flush()
+          os.fsync(fobj.fileno())
 
-    # Werkzeug FileStorage can only (easily) be saved with .save()
-    if isinstance(fdata, datastructures.FileStorage):
-      fdata.save(name) # pyright: reportUnknownMemberType=false
-    else:
-      with open(name, 'wb') as fobj:
-        fobj.write(fdata.getbuffer())
+      os.replace(tmp_name, name)
+    except BaseException:
+      os.unlink(tmp_name)
+      raise
 
+    if self.durable:
+      # The rename is only durable once the directory is synced
+      dir_fd = os.open(name.parent, os.O_RDONLY)
+      try:
+        os.fsync(dir_fd)
+      finally:
+        os.close(dir_fd)
+
+  @metrics.timed_storage('read')
   def read_file(self, file_id: str,
       variant: Optional[str] = None) -> io.IOBase:
     return open(self._get_filepath(file_id, variant), 'rb')
+
+  @metrics.timed_storage('delete')
+  def delete_file(self, file_id: str, variant: Optional[str] = None) -> None:
+    self._get_filepath(file_id, variant).unlink(missing_ok=True)
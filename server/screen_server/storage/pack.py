@@ -0,0 +1,273 @@
+""" StorageService which packs images into large, append-only segment files. """
+# pyright: reportImportCycles=false
+from __future__ import annotations
+import io
+import logging
+import os
+import pathlib
+import shutil
+import sqlite3
+import struct
+import threading
+import time
+from typing import Any, ContextManager, Optional, Union
+
+from werkzeug import datastructures
+
+from screen_server import metrics
+from screen_server import shared
+from screen_server.storage import storage
+
+LOGGER = logging.getLogger(__name__)
+
+RECORD_HEADER = struct.Struct('<4sHQ')
+""" Record header: magic, name length and data length. The name follows. """
+RECORD_MAGIC = b'SPK1'
+
+DEFAULT_SEGMENT_BYTES = 256 * 1024 * 1024
+COPY_CHUNK_SIZE = 1024 * 1024
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+  name TEXT PRIMARY KEY,
+  segment INTEGER NOT NULL,
+  offset INTEGER NOT NULL,
+  size INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS files_by_segment ON files (segment);
+"""
+
+class PackedFile(io.RawIOBase):
+  """ Read-only view of a single file within a segment.
+  This deliberately has no fileno(), since servers which use os.sendfile()
+  (e.g., gunicorn) would send the segment from the start of the view's file
+  descriptor rather than from the start of the file.
+  """
+  def __init__(self, fd: int, offset: int, size: int):
+    super().__init__()
+    self.fd = fd
+    self.offset = offset
+    self.size = size
+    self._pos = 0
+
+  def readable(self) -> bool:
+    return True
+
+  def seekable(self) -> bool:
+    return True
+
+  def readinto(self, buffer: Any) -> int:
+    count = min(len(buffer), self.size - self._pos)
+    if count <= 0:
+      return 0
+
+    # Positioned reads don't move the descriptor, so it can be shared
+    data = os.pread(self.fd, count, self.offset + self._pos)
+    buffer[:len(data)] = data
+    self._pos += len(data)
+    return len(data)
+
+  def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+    if whence == io.SEEK_CUR:
+      offset += self._pos
+    elif whence == io.SEEK_END:
+      offset += self.size
+    self._pos = max(0, offset)
+    return self._pos
+
+  def tell(self) -> int:
+    return self._pos
+
+  def close(self) -> None:
+    if not self.closed:
+      os.close(self.fd)
+    super().close()
+
+
+class PackStorageService(storage.StorageService):
+  """ Storage within a few large local segment files, rather than a file each.
+  Files are appended to the newest segment, and their locations are recorded
+  in an SQLite index. Overwritten files leave dead space behind, which is
+  reclaimed by periodically compacting segments which are mostly dead.
+  """
+  # Appends (in any process) are serialized by a lock file. Segments other than
+  # the newest are never appended to, so they can be compacted safely.
+  backend_name = 'pack'
+
+  def __init__(self, config: dict[str, str]):
+    super().__init__(config)
+
+    self.root_directory = pathlib.Path(config['STORAGE_LOCAL_DIR'])
+    self.root_directory.mkdir(exist_ok=True, parents=True)
+    self.lock_directory = self.root_directory / '.locks'
+    self.lock_directory.mkdir(exist_ok=True)
+    self.index_path = self.root_directory / 'index.sqlite3'
+
+    self.segment_bytes = int(config.get('STORAGE_PACK_SEGMENT_BYTES')
+                             or DEFAULT_SEGMENT_BYTES)
+    self.compact_interval = float(
+        config.get('STORAGE_PACK_COMPACT_SECONDS') or 3600)
+    self.compact_ratio = float(config.get('STORAGE_PACK_COMPACT_RATIO') or 0.5)
+
+    self._index = shared.PerThread(self._connect_index)
+    self._get_index().executescript(INDEX_SCHEMA)
+
+    if self.compact_interval > 0:
+      threading.Thread(target=self._compact_periodically, daemon=True,
+                       name='pack-compaction').start()
+
+  def _connect_index(self) -> sqlite3.Connection:
+    """ Open a connection to the index. """
+    conn = sqlite3.connect(self.index_path, isolation_level=None)
+    conn.execute('pragma journal_mode=wal;')
+    conn.execute('pragma synchronous=normal;')
+    conn.execute('pragma busy_timeout=5000;')
+    return conn
+
+  def _get_index(self) -> sqlite3.Connection:
+    """ Get this thread's connection to the index. """
+    return self._index.get()
+
+  def _get_segment_path(self, segment: int) -> pathlib.Path:
+    """ Return the path of a segment file. """
+    return self.root_directory / f'{segment:08d}.pack'
+
+  def _list_segments(self) -> list[int]:
+    """ Return the numbers of all segments, oldest first. """
+    return sorted(int(path.stem) for path in self.root_directory.glob('*.pack'))
+
+  def _lock(self, name: str, blocking: bool = True) -> ContextManager[bool]:
+    """ Take an exclusive lock across processes, as shared.file_lock(). """
+    return shared.file_lock(self.lock_directory / f'{name}.lock', blocking)
+
+  def _append(self, name: str, stream: Any) -> tuple[int, int, int]:
+    """ Append a file to the newest segment.
+    Returns the segment, and the offset and size of the data within it.
+    """
+    name_bytes = name.encode('utf-8')
+    with self._lock('append'):
+      segments = self._list_segments()
+      segment = segments[-1] if segments else 1
+      path = self._get_segment_path(segment)
+      if path.exists() and path.stat().st_size >= self.segment_bytes:
+        segment += 1
+        path = self._get_segment_path(segment)
+
+      # O_APPEND isn't used since the header is rewritten after the data
+      fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+      with os.fdopen(fd, 'r+b') as fobj:
+        start = fobj.seek(0, os.SEEK_END)
+        try:
+          fobj.write(RECORD_HEADER.pack(RECORD_MAGIC, len(name_bytes), 0))
+          fobj.write(name_bytes)
+          offset = fobj.tell()
+          shutil.copyfileobj(stream, fobj, COPY_CHUNK_SIZE)
+          size = fobj.tell() - offset
+
+          # The size is only known once the data has been streamed
+          fobj.seek(start)
+          fobj.write(RECORD_HEADER.pack(RECORD_MAGIC, len(name_bytes), size))
+          fobj.flush()
+        except BaseException:
+          fobj.truncate(start)
+          raise
+
+    return segment, offset, size
+
+  @metrics.timed_storage('write')
+  def write_file(self, file_id: str,
+      fdata: Union[datastructures.FileStorage, io.IOBase],
+      variant: Optional[str] = None) -> None:
+    name = self._get_filename(file_id, variant)
+    stream = (fdata.stream if isinstance(fdata, datastructures.FileStorage)
+              else fdata)
+
+    segment, offset, size = self._append(name, stream)
+    # Replaces the location of an overwritten file, leaving it as dead space
+    self._get_index().execute('INSERT OR REPLACE INTO files '
+                              '  (name, segment, offset, size) '
+                              'VALUES (?, ?, ?, ?)',
+                              (name, segment, offset, size))
+
+  @metrics.timed_storage('read')
+  def read_file(self, file_id: str,
+      variant: Optional[str] = None) -> io.IOBase:
+    name = self._get_filename(file_id, variant)
+    # The segment might be compacted away between the lookup and opening it, in
+    # which case the file will have been moved
+    for _ in range(2):
+      row = self._get_index().execute(
+          'SELECT segment, offset, size FROM files WHERE name = ?',
+          (name, )).fetchone()
+      if row is None:
+        break
+
+      segment, offset, size = row
+      try:
+        fd = os.open(self._get_segment_path(segment), os.O_RDONLY)
+      except FileNotFoundError:
+        continue
+
+      return PackedFile(fd, offset, size)
+
+    raise FileNotFoundError(name)
+
+  @metrics.timed_storage('delete')
+  def delete_file(self, file_id: str, variant: Optional[str] = None) -> None:
+    # The file is left as dead space, to be reclaimed by compaction
+    self._get_index().execute('DELETE FROM files WHERE name = ?',
+                              (self._get_filename(file_id, variant), ))
+
+  def _compact_segment(self, segment: int) -> None:
+    """ Move the live files out of a segment, and then delete it. """
+    conn = self._get_index()
+    rows = conn.execute('SELECT name, offset, size FROM files '
+                        'WHERE segment = ?', (segment, )).fetchall()
+    fd = os.open(self._get_segment_path(segment), os.O_RDONLY)
+    for name, offset, size in rows:
+      with PackedFile(os.dup(fd), offset, size) as src:
+        new_segment, new_offset, _ = self._append(name, src)
+      # The file might have been overwritten while it was being moved, in which
+      # case the copy is dead
+      conn.execute('UPDATE files SET segment = ?, offset = ? '
+                   'WHERE name = ? AND segment = ? AND offset = ?',
+                   (new_segment, new_offset, name, segment, offset))
+    os.close(fd)
+
+    # Readers which already opened the segment can still read it once deleted
+    if not conn.execute('SELECT 1 FROM files WHERE segment = ? LIMIT 1',
+                        (segment, )).fetchone():
+      self._get_segment_path(segment).unlink()
+      LOGGER.info('Compacted segment %d, moving %d files', segment, len(rows))
+
+  def compact(self) -> int:
+    """ Compact segments which are mostly dead space.
+    Returns the number of segments compacted. Only one process compacts at a
+    time, so this returns 0 immediately if another process is compacting.
+    """
+    compacted = 0
+    with self._lock('compact', blocking=False) as locked:
+      if not locked:
+        return 0
+
+      # The newest segment is still being appended to
+      for segment in self._list_segments()[:-1]:
+        live_bytes = self._get_index().execute(
+            'SELECT COALESCE(SUM(size), 0) FROM files WHERE segment = ?',
+            (segment, )).fetchone()[0]
+        total_bytes = self._get_segment_path(segment).stat().st_size
+        if live_bytes <= total_bytes * (1 - self.compact_ratio):
+          self._compact_segment(segment)
+          compacted += 1
+
+    return compacted
+
+  def _compact_periodically(self) -> None:
+    """ Compact segments forever, in a background thread. """
+    while True:
+      time.sleep(self.compact_interval)
+      try:
+        self.compact()
+      except Exception: # pylint: disable=broad-except
+        LOGGER.exception('Unable to compact segments')
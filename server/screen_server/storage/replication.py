@@ -0,0 +1,305 @@
+""" Write-back of files to cloud storage, via a persistent local queue. """
+# pyright: reportImportCycles=false
+from __future__ import annotations
+import io
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+from typing import Callable, ContextManager, Optional, Union
+
+from werkzeug import datastructures
+
+from screen_server import metrics
+from screen_server import shared
+from screen_server.storage import local
+from screen_server.storage import storage
+
+LOGGER = logging.getLogger(__name__)
+
+QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pending (
+  name TEXT PRIMARY KEY,
+  file_id TEXT NOT NULL,
+  variant TEXT,
+  -- Changed whenever the file is rewritten, so that a replication of an older
+  -- version doesn't complete the newer one
+  token TEXT NOT NULL,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  next_attempt REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS pending_by_next_attempt ON pending (next_attempt);
+"""
+
+POLL_SECONDS = 5
+""" How often the queue is checked for files queued by other processes. """
+
+LEASE_SECONDS = 600
+""" How long a replication may take before another process retries it. """
+
+MAX_RETRY_SECONDS = 3600
+
+UploadFunc = Callable[[str, datastructures.FileStorage, Optional[str]], None]
+DeleteFunc = Callable[[str, Optional[str]], None]
+
+class ReplicationQueue():
+  """ Queue of files to replicate, in an SQLite database shared by processes.
+  Each file is claimed by pushing its next attempt back by a lease, so a file
+  whose replication was interrupted (e.g., by a restart) is retried later.
+  """
+  def __init__(self, directory: pathlib.Path):
+    self.path = directory / 'queue.sqlite3'
+    self.lock_directory = directory / '.locks'
+    self.lock_directory.mkdir(exist_ok=True, parents=True)
+
+    self._conns = shared.PerThread(self._connect)
+    self._get_conn().executescript(QUEUE_SCHEMA)
+
+  def _connect(self) -> sqlite3.Connection:
+    """ Open a connection to the queue. """
+    conn = sqlite3.connect(self.path, isolation_level=None)
+    # Commits are synced (synchronous is left at FULL) since uploads are
+    # acknowledged once they're queued
+    conn.execute('pragma journal_mode=wal;')
+    conn.execute('pragma busy_timeout=5000;')
+    return conn
+
+  def _get_conn(self) -> sqlite3.Connection:
+    """ Get this thread's connection to the queue. """
+    return self._conns.get()
+
+  def lock(self, name: str) -> ContextManager[bool]:
+    """ Take an exclusive lock on a file's entry, across processes. """
+    return shared.striped_lock(self.lock_directory, name)
+
+  def add(self, name: str, file_id: str, variant: Optional[str]) -> None:
+    """ Queue a file, replacing any earlier version of it in the queue. """
+    self._get_conn().execute(
+        'INSERT INTO pending (name, file_id, variant, token, next_attempt) '
+        'VALUES (?, ?, ?, ?, ?) '
+        'ON CONFLICT (name) DO UPDATE SET token = excluded.token, '
+        '  attempts = 0, next_attempt = excluded.next_attempt',
+        (name, file_id, variant, os.urandom(8).hex(), time.time()))
+
+  def has(self, name: str) -> bool:
+    """ Check whether a file is queued. """
+    return self._get_conn().execute('SELECT 1 FROM pending WHERE name = ?',
+                                    (name, )).fetchone() is not None
+
+  def claim(self) -> Optional[tuple[str, str, Optional[str], str, int]]:
+    """ Claim the next file which is due, if any.
+    Returns the name, file ID, variant, token and number of previous attempts.
+    """
+    conn = self._get_conn()
+    now = time.time()
+    # The write lock is taken up front so that processes can't claim the same
+    # file
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+      row = conn.execute('SELECT name, file_id, variant, token, attempts '
+                         'FROM pending WHERE next_attempt <= ? '
+                         'ORDER BY next_attempt LIMIT 1', (now, )).fetchone()
+      if row:
+        conn.execute('UPDATE pending SET next_attempt = ? WHERE name = ?',
+                     (now + LEASE_SECONDS, row[0]))
+      conn.execute('COMMIT')
+    except BaseException:
+      conn.execute('ROLLBACK')
+      raise
+
+    return row
+
+  def is_current(self, name: str, token: str) -> bool:
+    """ Check whether a claimed file is still the version which is queued. """
+    return self._get_conn().execute(
+        'SELECT 1 FROM pending WHERE name = ? AND token = ?',
+        (name, token)).fetchone() is not None
+
+  def complete(self, name: str, token: str) -> None:
+    """ Remove a replicated file from the queue. """
+    self._get_conn().execute('DELETE FROM pending WHERE name = ? AND token = ?',
+                             (name, token))
+
+  def remove(self, name: str) -> None:
+    """ Remove a file from the queue, whichever version is queued. """
+    self._get_conn().execute('DELETE FROM pending WHERE name = ?', (name, ))
+
+  def retry(self, name: str, token: str, delay: float) -> None:
+    """ Schedule another attempt to replicate a file. """
+    self._get_conn().execute(
+        'UPDATE pending SET attempts = attempts + 1, next_attempt = ? '
+        'WHERE name = ? AND token = ?', (time.time() + delay, name, token))
+
+  def __len__(self) -> int:
+    return self._get_conn().execute(
+        'SELECT COUNT(*) FROM pending').fetchone()[0]
+
+
+class WriteBack():
+  """ Stages files locally and replicates them to a remote service later.
+  Files are durably written to a staging directory and queued, and then
+  uploaded by a background thread, with retries. Staged files are read until
+  they've been replicated, at which point they're moved to the local cache (if
+  there is one).
+  """
+  # Staged files are only removed with the file's lock held, and after checking
+  # that the file hasn't been rewritten since it was uploaded.
+  def __init__(self, config: dict[str, str], upload: UploadFunc,
+               delete: DeleteFunc,
+               local_cache: Optional[storage.StorageService] = None):
+    # The directory is dot-prefixed so that local cache scans skip it
+    directory = pathlib.Path(config['STORAGE_LOCAL_DIR']) / '.pending'
+    self.staging = local.LocalFileSystemStorageService(
+        {**config, 'STORAGE_LOCAL_DIR': str(directory)}, durable=True)
+    self.queue = ReplicationQueue(directory)
+    self.upload = upload
+    self.delete = delete
+    self.local_cache = local_cache
+    self.retry_seconds = float(config.get('STORAGE_WRITE_BACK_RETRY_SECONDS')
+                               or 5)
+
+    self._wakeup = threading.Event()
+    self._start_lock = threading.Lock()
+    self._started_pid: Optional[int] = None
+
+  def _ensure_started(self) -> None:
+    """ Start replicating in the background, once per process.
+    This is done on first use, rather than on creation, so that the remote
+    service is fully set up first and so that a process which forks (e.g., a
+    preloading server) doesn't start a thread which its children won't have.
+    """
+    if self._started_pid == os.getpid():
+      return
+
+    with self._start_lock:
+      if self._started_pid != os.getpid():
+        self._recover()
+        threading.Thread(target=self._replicate_forever, daemon=True,
+                         name='write-back').start()
+        self._started_pid = os.getpid()
+
+  def _recover(self) -> None:
+    """ Queue staged files which were written but never queued (e.g., if the
+    process was killed in between).
+    """
+    recovered = 0
+    for dirpath, dirnames, filenames in os.walk(self.staging.root_directory):
+      dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+      for filename in filenames:
+        stem, _, extension = filename.rpartition('.')
+        if filename.startswith('.') or extension not in storage.CONTENT_TYPES:
+          continue
+
+        with self.queue.lock(filename):
+          if (self.queue.has(filename)
+              or not os.path.exists(os.path.join(dirpath, filename))):
+            continue
+          # File IDs never contain underscores, so this reverses _get_filename
+          file_id, _, variant = stem.partition('_')
+          if extension != 'png':
+            variant = f'{variant}.{extension}'
+          self.queue.add(filename, file_id, variant or None)
+          recovered += 1
+
+    if recovered:
+      LOGGER.warning('Queued %d staged files for replication', recovered)
+    LOGGER.info('%d files are waiting for replication', len(self.queue))
+
+  def write_file(self, file_id: str,
+      fdata: Union[datastructures.FileStorage, io.IOBase],
+      variant: Optional[str] = None) -> None:
+    """ Stage the file and queue it for replication. """
+    self._ensure_started()
+    # pylint: disable=protected-access
+    name = self.staging._get_filename(file_id, variant)
+    with self.queue.lock(name):
+      self.staging.write_file(file_id, fdata, variant)
+      self.queue.add(name, file_id, variant)
+
+    self._wakeup.set()
+
+  def read_file(self, file_id: str,
+      variant: Optional[str] = None) -> Optional[io.IOBase]:
+    """ Read the staged file, if it hasn't been replicated yet. """
+    self._ensure_started()
+    try:
+      return self.staging.read_file(file_id, variant)
+    except FileNotFoundError:
+      return None
+
+  def delete_file(self, file_id: str, variant: Optional[str] = None) -> None:
+    """ Unstage the file, so that it isn't replicated. """
+    # pylint: disable=protected-access
+    name = self.staging._get_filename(file_id, variant)
+    with self.queue.lock(name):
+      self.queue.remove(name)
+      self.staging.delete_file(file_id, variant)
+
+  def is_pending(self, file_id: str, variant: Optional[str] = None) -> bool:
+    """ Check whether the file hasn't been replicated yet. """
+    return self.staging._get_filepath( # pylint: disable=protected-access
+        file_id, variant).exists()
+
+  def _finish(self, name: str, file_id: str, variant: Optional[str],
+              token: str) -> None:
+    """ Move a replicated file from staging to the local cache. """
+    with self.queue.lock(name):
+      if not self.queue.is_current(name, token):
+        # The file was deleted during the upload, which might have recreated it
+        if not self.queue.has(name):
+          self.delete(file_id, variant)
+        # Otherwise it was rewritten, and will be uploaded again
+        return
+
+      if self.local_cache:
+        with self.staging.read_file(file_id, variant) as fobj:
+          self.local_cache.write_file(file_id, fobj, variant)
+
+      self.staging._get_filepath( # pylint: disable=protected-access
+          file_id, variant).unlink()
+      self.queue.complete(name, token)
+
+  def replicate_one(self) -> bool:
+    """ Replicate the next file which is due. Returns whether there was one. """
+    claimed = self.queue.claim()
+    if not claimed:
+      return False
+
+    name, file_id, variant, token, attempts = claimed
+    try:
+      with self.staging.read_file(file_id, variant) as fobj:
+        self.upload(file_id, datastructures.FileStorage(fobj), variant)
+      self._finish(name, file_id, variant, token)
+    except FileNotFoundError:
+      # Nothing can be done if the staged file has gone missing
+      LOGGER.error('Staged file %s is missing, so it was not replicated', name)
+      self.queue.complete(name, token)
+      metrics.count_replication(False)
+    except Exception: # pylint: disable=broad-except
+      delay = min(self.retry_seconds * 2 ** attempts, MAX_RETRY_SECONDS)
+      LOGGER.exception('Unable to replicate %s (attempt %d), retrying in %gs',
+                       name, attempts + 1, delay)
+      self.queue.retry(name, token, delay)
+      metrics.count_replication(False)
+    else:
+      metrics.count_replication(True)
+
+    return True
+
+  def _replicate_forever(self) -> None:
+    """ Replicate queued files forever, in a background thread. """
+    while True:
+      # Cleared first so that files queued while replicating aren't missed
+      self._wakeup.clear()
+      try:
+        while self.replicate_one():
+          pass
+      except Exception: # pylint: disable=broad-except
+        LOGGER.exception('Unable to read the replication queue')
+
+      # Woken early by writes in this process, otherwise polling for retries
+      # and for files queued by other processes
+      self._wakeup.wait(POLL_SECONDS)
@@ -1,16 +1,19 @@
 """ StorageService for reading/writing images in S3 buckets. """
 # pyright: reportImportCycles=false
-import io
-import shutil
 from typing import Optional
 
 import boto3
+from boto3.s3 import transfer
+from botocore import exceptions
 from werkzeug import datastructures
 
+from screen_server import metrics
 from screen_server.storage import storage
 
 class S3StorageService(storage.CloudStorageService):
   """ StorageService for reading/writing images in S3. """
+  backend_name = 's3'
+
   def __init__(self, config: dict[str, str],
                local_cache: Optional[storage.StorageService]):
     """ Create s3 session. """
@@ -20,36 +23,53 @@ class S3StorageService(storage.CloudStorageService):
       aws_access_key_id=config['STORAGE_S3_KEY'],
       aws_secret_access_key=config['STORAGE_S3_SECRET']
     )
-    resource = session.resource('s3')
+    # A custom endpoint allows for S3-compatible services, e.g. MinIO
+    resource = session.resource(
+        's3', endpoint_url=config.get('STORAGE_S3_ENDPOINT_URL') or None)
     self.bucket = resource.Bucket(config['STORAGE_S3_BUCKET'])
 
-  def write_file(self, file_id: str, fdata: datastructures.FileStorage,
-      variant: Optional[str] = None) -> None:
-    """Put image in s3 bucket and possibly save a cache locally. """
-    # upload_fileobj() closes the file so we give it a copy
-    fileobj = io.BytesIO()
-    shutil.copyfileobj(fdata.stream, fileobj)
-
-    self.bucket.upload_fileobj(fileobj, self._get_filename(file_id, variant))
+    # By default, multipart uploads buffer several parts in parallel
+    self.transfer_config = (transfer.TransferConfig(use_threads=False)
+                            if self.memory_bounded else None)
 
-    # If local_cache is defined then also save to filesystem
-    self._maybe_cache_locally(file_id, fdata, variant)
+  @metrics.timed_storage('write')
+  def _write_remote(self, file_id: str, fdata: datastructures.FileStorage,
+                    variant: Optional[str] = None) -> None:
+    """ Put image in s3 bucket. """
+    # The upload is streamed from the request. upload_fileobj() closes the file
+    # so we give it a proxy.
+    fdata.stream.seek(0)
+    self.bucket.upload_fileobj(storage.NonClosingStream(fdata.stream),
+                               self._get_filename(file_id, variant),
+                               ExtraArgs={'ContentType':
+                                          self.get_content_type(variant)},
+                               Config=self.transfer_config)
 
-  def read_file(self, file_id: str, variant: Optional[str] = None) -> io.IOBase:
-    """ Read file from possible local cache and S3 bucket. """
-    # If local cache has been set up then try to read file from there first
-    if self.local_cache:
-      try:
-        return self.local_cache.read_file(file_id, variant)
-      except FileNotFoundError:
-        pass
-
-    # File not available locally -- get from s3
+  @metrics.timed_storage('open')
+  def _open_remote(self, file_id: str,
+                   variant: Optional[str] = None) -> storage.RemoteFile:
+    """ Open streaming download of file from S3 bucket. """
     name = self._get_filename(file_id, variant)
-    fdata = io.BytesIO()
-    self.bucket.download_fileobj(name, fdata)
+    try:
+      resp = self.bucket.Object(name).get()
+    except exceptions.ClientError as exc:
+      if exc.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+        raise FileNotFoundError(name) from exc
+      raise
+
+    return storage.RemoteFile(resp['Body'], resp['ContentLength'])
 
-    self._maybe_cache_locally(file_id, fdata, variant)
+  @metrics.timed_storage('delete')
+  def _delete_remote(self, file_id: str,
+                     variant: Optional[str] = None) -> None:
+    """ Delete file from S3 bucket. """
+    # S3 doesn't fail if the object doesn't exist
+    self.bucket.Object(self._get_filename(file_id, variant)).delete()
 
-    fdata.seek(0)
-    return fdata
+  def _sign_url(self, file_id: str, variant: Optional[str] = None) -> str:
+    """ Generate a pre-signed URL to read the file from the S3 bucket. """
+    return self.bucket.meta.client.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': self.bucket.name,
+                'Key': self._get_filename(file_id, variant)},
+        ExpiresIn=self.signed_url_expiry)
@@ -0,0 +1,75 @@
+""" Coalescing of concurrent, identical fetches into a single call. """
+from __future__ import annotations
+import contextlib
+import pathlib
+import threading
+from typing import Callable, ContextManager, Generic, Optional, TypeVar, cast
+
+from screen_server import shared
+
+T = TypeVar('T')
+
+class _Call(Generic[T]):
+  """ A fetch in progress which other callers can wait on. """
+  def __init__(self):
+    self.done = threading.Event()
+    self.result: Optional[T] = None
+    self.error: Optional[BaseException] = None
+
+
+class SingleFlight(Generic[T]):
+  """ Ensure only one fetch per key is in flight at a time.
+  Within a process, concurrent callers for the same key wait for the first
+  caller (the leader) and share its result. If a lock directory is provided then
+  leaders in different processes also take an exclusive file lock, so that a
+  leader which had to wait for another process can re-check for the result
+  (e.g., in a shared cache) instead of repeating the fetch.
+  """
+  def __init__(self, lock_dir: Optional[pathlib.Path] = None):
+    self.lock_dir = lock_dir
+    if lock_dir:
+      lock_dir.mkdir(exist_ok=True, parents=True)
+
+    self._lock = threading.Lock()
+    self._calls: dict[str, _Call[T]] = {}
+
+  def _process_lock(self, key: str) -> ContextManager[bool]:
+    """ Take the cross-process lock for a key; yield whether it was taken
+    without waiting.
+    """
+    if not self.lock_dir:
+      return contextlib.nullcontext(True)
+    return shared.striped_lock(self.lock_dir, key)
+
+  def do(self, key: str, fetch: Callable[[], T],
+         recheck: Optional[Callable[[], Optional[T]]] = None) -> T:
+    """ Call fetch() for key, unless a call for the same key is in flight.
+    recheck() is called if another process held the lock for this key. If it
+    returns anything other than None then fetch() is skipped.
+    """
+    with self._lock:
+      call = self._calls.get(key)
+      is_leader = call is None
+      if call is None:
+        call = self._calls[key] = _Call[T]()
+
+    if not is_leader:
+      call.done.wait()
+      if call.error:
+        raise call.error
+      return cast(T, call.result)
+
+    try:
+      with self._process_lock(key) as immediate:
+        result = recheck() if not immediate and recheck else None
+        if result is None:
+          result = fetch()
+      call.result = result
+      return result
+    except BaseException as exc:
+      call.error = exc
+      raise
+    finally:
+      with self._lock:
+        del self._calls[key]
+      call.done.set()
@@ -3,25 +3,46 @@ from __future__ import annotations
 import abc
 import io
 import logging
-from typing import Optional
+import pathlib
+from typing import TYPE_CHECKING, Any, Optional
 
 from werkzeug import datastructures
 
+from screen_server import metrics
+from screen_server.storage import singleflight
+
+if TYPE_CHECKING:
+  from screen_server.storage import replication
+
 LOGGER = logging.getLogger(__name__)
 
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+CONTENT_TYPES = {
+  'png': 'image/png',
+  'webp': 'image/webp',
+  'avif': 'image/avif',
+}
+""" Content types of the formats files are stored in, by file extension. """
+
 def _get_local_cache(config: dict[str, str]) -> Optional['StorageService']:
-  """ Return a LocalFileSystemStorageService if local cache is configured. """
+  """ Return a LocalCacheStorageService if local cache is configured. """
   if config.get('STORAGE_CLOUD_LOCAL_CACHE'):
     # pylint: disable=import-outside-toplevel
-    from screen_server.storage import local
+    from screen_server.storage import cache
 
     LOGGER.info('Creating local filesystem service for caching')
-    return local.LocalFileSystemStorageService(config)
+    return cache.LocalCacheStorageService(config)
 
   return None
 
 class StorageService(abc.ABC):
   """ Abstract class representing a storage service to store image files. """
+  # Directory for lock files, if the service is backed by a shared filesystem
+  lock_directory: Optional[pathlib.Path] = None
+  # Name of the backend in metrics
+  backend_name = ''
+
   def __init__(self, _: dict[str, str],
                local_cache: Optional[StorageService] = None):
     self.local_cache = local_cache
@@ -40,9 +61,18 @@ class StorageService(abc.ABC):
 
   @classmethod
   def _get_filename(cls, file_id: str, variant: Optional[str] = None) -> str:
-    """ Generate a filename from the ID and the variant. """
-    variant = f'_{variant}' if variant else ''
-    return f'{file_id}{variant}.png'
+    """ Generate a filename from the ID and the variant.
+    Variants in a format other than PNG end with its extension (e.g.,
+    thumbnail.webp, or .webp for the original image).
+    """
+    name, _, extension = (variant or '').partition('.')
+    name = f'_{name}' if name else ''
+    return f'{file_id}{name}.{extension or "png"}'
+
+  @classmethod
+  def get_content_type(cls, variant: Optional[str] = None) -> str:
+    """ Return the content type of a file, from its variant. """
+    return CONTENT_TYPES[(variant or '').partition('.')[2] or 'png']
 
   @abc.abstractmethod
   def write_file(self, file_id: str, fdata: datastructures.FileStorage,
@@ -55,6 +85,16 @@ class StorageService(abc.ABC):
       variant: Optional[str] = None) -> io.IOBase:
     """ Read file from storage. """
 
+  @abc.abstractmethod
+  def delete_file(self, file_id: str, variant: Optional[str] = None) -> None:
+    """ Delete the file from storage, if it exists. """
+
+  def get_url(self, file_id: str,
+              variant: Optional[str] = None) -> Optional[str]:
+    """ Return a short-lived URL to read the file directly, if supported. """
+    # pylint: disable=unused-argument
+    return None
+
   @classmethod
   def get_instance(cls, config: dict[str, str]) -> StorageService:
     """ Get appropriate instance of StorageService based on config settings. """
@@ -67,6 +107,13 @@ class StorageService(abc.ABC):
       LOGGER.info('Creating local filesystem service')
       return local.LocalFileSystemStorageService(config)
 
+    # Service = PACK
+    if config['STORAGE_SERVICE'] == 'PACK':
+      from screen_server.storage import pack
+
+      LOGGER.info('Creating pack file service')
+      return pack.PackStorageService(config)
+
     # Service = S3
     if config['STORAGE_SERVICE'] == 'S3':
       from screen_server.storage import s3
@@ -84,3 +131,201 @@ class StorageService(abc.ABC):
     # Service is not available
     raise ValueError((f'{config["STORAGE_SERVICE"]} storage service is not '
                       'available'))
+
+
+class RemoteFile(io.RawIOBase):
+  """ Read-only stream of a file being downloaded from a remote service. """
+  def __init__(self, stream: Any, size: Optional[int] = None):
+    super().__init__()
+    self._stream = stream
+    self.size = size
+
+  def readable(self) -> bool:
+    return True
+
+  def readinto(self, buffer: Any) -> int:
+    data = self._stream.read(len(buffer))
+    buffer[:len(data)] = data
+    return len(data)
+
+  def readall(self) -> bytes:
+    return self._stream.read()
+
+  def close(self) -> None:
+    if not self.closed:
+      self._stream.close()
+    super().close()
+
+
+class NonClosingStream(io.RawIOBase):
+  """ Proxy for a seekable stream which leaves it open when closed. """
+  def __init__(self, stream: Any):
+    super().__init__()
+    self._stream = stream
+
+  def readable(self) -> bool:
+    return True
+
+  def seekable(self) -> bool:
+    return True
+
+  def readinto(self, buffer: Any) -> int:
+    return self._stream.readinto(buffer)
+
+  def read(self, size: int = -1) -> bytes:
+    return self._stream.read(size)
+
+  def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+    return self._stream.seek(offset, whence)
+
+  def tell(self) -> int:
+    return self._stream.tell()
+
+
+class CloudStorageService(StorageService):
+  """ Abstract class for remote storage services, with optional local cache. """
+  def __init__(self, config: dict[str, str],
+               local_cache: Optional[StorageService] = None):
+    super().__init__(config, local_cache)
+
+    self.chunk_size = int(config.get('STORAGE_CHUNK_SIZE')
+                          or DEFAULT_CHUNK_SIZE)
+    # In memory-bounded mode files are never fully buffered in memory
+    self.memory_bounded = bool(config.get('STORAGE_MEMORY_BOUNDED'))
+    self.signed_urls = bool(config.get('STORAGE_SIGNED_URLS'))
+    self.signed_url_expiry = int(config.get('STORAGE_SIGNED_URL_EXPIRY')
+                                 or 300)
+
+    # Concurrent misses for the same file share a single download. If there's a
+    # local cache then processes sharing it are coordinated too.
+    self._flights: singleflight.SingleFlight[Any] = (
+        singleflight.SingleFlight(local_cache.lock_directory
+                                  if local_cache else None))
+
+    # In write-back mode files are staged locally and uploaded in the background
+    self.write_back: Optional[replication.WriteBack] = None
+    if config.get('STORAGE_WRITE_BACK'):
+      # pylint: disable=import-outside-toplevel
+      from screen_server.storage import replication
+
+      LOGGER.info('Writing back to %s asynchronously', self.backend_name)
+      self.write_back = replication.WriteBack(config, self._write_remote,
+                                              self._delete_remote, local_cache)
+
+  @abc.abstractmethod
+  def _write_remote(self, file_id: str, fdata: datastructures.FileStorage,
+                    variant: Optional[str] = None) -> None:
+    """ Upload the file to the remote service. """
+
+  @abc.abstractmethod
+  def _open_remote(self, file_id: str,
+                   variant: Optional[str] = None) -> RemoteFile:
+    """ Open a streaming download of the file from the remote service. """
+
+  @abc.abstractmethod
+  def _delete_remote(self, file_id: str,
+                     variant: Optional[str] = None) -> None:
+    """ Delete the file from the remote service, if it exists. """
+
+  @abc.abstractmethod
+  def _sign_url(self, file_id: str, variant: Optional[str] = None) -> str:
+    """ Generate a pre-signed URL to read the file from the remote service. """
+
+  def get_url(self, file_id: str,
+              variant: Optional[str] = None) -> Optional[str]:
+    """ Return a pre-signed URL for the file, if signed URLs are enabled. """
+    # Files which haven't been replicated yet aren't available remotely
+    if not self.signed_urls or (self.write_back
+                                and self.write_back.is_pending(file_id,
+                                                               variant)):
+      return None
+
+    return self._sign_url(file_id, variant)
+
+  def write_file(self, file_id: str, fdata: datastructures.FileStorage,
+      variant: Optional[str] = None) -> None:
+    """ Save the file to the remote service, or stage it to be replicated. """
+    if self.write_back:
+      self.write_back.write_file(file_id, fdata, variant)
+      return
+
+    self._write_remote(file_id, fdata, variant)
+    # If local_cache is defined then also save to filesystem
+    self._maybe_cache_locally(file_id, fdata, variant)
+
+  def delete_file(self, file_id: str, variant: Optional[str] = None) -> None:
+    """ Delete the file from the remote service, staging and the local cache.
+    """
+    # Unstaged first, so that it isn't replicated after it's deleted
+    if self.write_back:
+      self.write_back.delete_file(file_id, variant)
+    self._delete_remote(file_id, variant)
+    if self.local_cache:
+      self.local_cache.delete_file(file_id, variant)
+
+  def _read_local_cache(self, file_id: str,
+                        variant: Optional[str] = None) -> Optional[io.IOBase]:
+    """ Read the file from the local cache, if configured and available. """
+    if self.local_cache:
+      try:
+        return self.local_cache.read_file(file_id, variant)
+      except FileNotFoundError:
+        pass
+
+    return None
+
+  def _fetch_to_cache(self, file_id: str,
+                      variant: Optional[str] = None) -> bool:
+    """ Stream the file from the remote service into the local cache. """
+    assert self.local_cache
+    with self._open_remote(file_id, variant) as remote:
+      self.local_cache.write_file(file_id, remote, variant)
+    return True
+
+  def _recheck_local_cache(self, file_id: str,
+                           variant: Optional[str] = None) -> Optional[bool]:
+    """ Check the local cache after waiting on another process. """
+    fobj = self._read_local_cache(file_id, variant)
+    if fobj is None:
+      return None
+
+    fobj.close()
+    return True
+
+  def _fetch(self, file_id: str, variant: Optional[str] = None) -> bytes:
+    """ Download the whole file from the remote service. """
+    with self._open_remote(file_id, variant) as remote:
+      return remote.read()
+
+  @metrics.timed_storage('read')
+  def read_file(self, file_id: str, variant: Optional[str] = None) -> io.IOBase:
+    """ Read file from possible local cache and the remote service. """
+    # Staged files are read first, since a rewritten file might still have an
+    # older version in the local cache
+    if self.write_back:
+      fobj = self.write_back.read_file(file_id, variant)
+      if fobj:
+        return fobj
+
+    # If local cache has been set up then try to read file from there first
+    fobj = self._read_local_cache(file_id, variant)
+    if fobj:
+      return fobj
+
+    # File not available locally -- get from the remote service
+    key = self._get_filename(file_id, variant)
+    if self.local_cache:
+      # The download is streamed straight to the local cache, and then every
+      # waiting request reads it from there
+      self._flights.do(key, lambda: self._fetch_to_cache(file_id, variant),
+                       lambda: self._recheck_local_cache(file_id, variant))
+      fobj = self._read_local_cache(file_id, variant)
+      if fobj:
+        return fobj
+      # The file was evicted already, so fall back to streaming it
+
+    if self.memory_bounded or self.local_cache:
+      return self._open_remote(file_id, variant)
+
+    data = self._flights.do(key, lambda: self._fetch(file_id, variant))
+    return io.BytesIO(data)
@@ -0,0 +1,167 @@
+""" Transcoding of images to smaller formats (WebP, AVIF) for capable clients.
+"""
+import concurrent.futures
+import functools
+import io
+import logging
+import threading
+from typing import Any, Optional
+
+from PIL import Image as PILImage
+from werkzeug import datastructures
+
+from screen_server import lru
+from screen_server import variants
+from screen_server.storage import singleflight
+from screen_server.storage import storage
+
+LOGGER = logging.getLogger(__name__)
+
+FORMATS: dict[str, tuple[str, dict[str, Any]]] = {
+  # Lossless, so screenshot text stays sharp
+  'webp': ('WEBP', {'lossless': True, 'quality': 80, 'method': 4}),
+  # Pillow can't encode lossless AVIF, so this is the closest it gets
+  'avif': ('AVIF', {'quality': 100, 'subsampling': '4:4:4', 'speed': 6}),
+}
+""" Format names and the Pillow format and options each is saved with. """
+
+PENDING_MAX_AGE = 60
+""" Seconds for which clients may cache the PNG sent while a transcode of it is
+being created, after which they request the image again.
+"""
+
+READY_CACHE_SIZE = 10000
+""" Number of transcodes whose readiness is remembered by each process. """
+
+READY_CACHE_TTL = 600
+
+def get_variant(variant: Optional[str], fmt: str) -> str:
+  """ Return the storage variant name for a (variant of an) image in a format.
+  """
+  return f'{variant or ""}.{fmt}'
+
+class TranscodeService():
+  """ Creates and reads images and their variants in other formats.
+  Transcodes are created in the background the first time they're requested,
+  and the original PNG is served until then. A transcode which isn't smaller
+  than the PNG is stored empty, so that it isn't retried and the PNG continues
+  to be served.
+  """
+  def __init__(self, config: dict[str, str], store: storage.StorageService,
+               variant_service: variants.VariantService):
+    self.storage = store
+    self.variants = variant_service
+    PILImage.init()
+    self.formats = [
+        fmt.strip() for fmt in config.get('IMAGE_FORMATS', 'webp').split(',')
+        if fmt.strip() in FORMATS and FORMATS[fmt.strip()][0] in PILImage.SAVE]
+    self.executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=int(config.get('TRANSCODE_WORKERS') or 1),
+        thread_name_prefix='transcode')
+
+    self._flights: singleflight.SingleFlight[bool] = (
+        singleflight.SingleFlight())
+    self._lock = threading.Lock()
+    self._queued: set[str] = set()
+    # Whether transcodes exist and are smaller than the PNG, which doesn't
+    # change once they're created
+    self._ready: lru.LruCache[bool] = lru.LruCache(READY_CACHE_SIZE,
+                                                   READY_CACHE_TTL)
+
+  def negotiate(self, accept: datastructures.MIMEAccept) -> Optional[str]:
+    """ Return the preferred format which the client accepts, if any. """
+    # Browsers accept image/* but only list the modern formats they support, so
+    # wildcards aren't matched
+    for fmt in self.formats:
+      if any(value == storage.CONTENT_TYPES[fmt] and quality > 0
+             for value, quality in accept):
+        return fmt
+
+    return None
+
+  def _create(self, file_id: str, variant: Optional[str], fmt: str) -> bool:
+    """ Transcode the image and save it to storage. """
+    # Variants are created if they don't exist yet
+    with (self.variants.read_file(file_id, variant) if variant
+          else self.storage.read_file(file_id)) as fobj:
+      png = fobj.read()
+
+    img = PILImage.open(io.BytesIO(png))
+    pil_format, options = FORMATS[fmt]
+    out = io.BytesIO()
+    img.save(out, format=pil_format, **options)
+    if out.tell() >= len(png):
+      out = io.BytesIO()
+
+    out.seek(0)
+    self.storage.write_file(file_id, datastructures.FileStorage(out),
+                            get_variant(variant, fmt))
+    LOGGER.debug('Created %s variant for %s, %d bytes from %d',
+                 get_variant(variant, fmt), file_id, len(out.getbuffer()),
+                 len(png))
+    return True
+
+  def _create_queued(self, file_id: str, variant: Optional[str],
+                     fmt: str) -> None:
+    """ Create a queued transcode, logging any failure. """
+    key = f'{file_id}_{get_variant(variant, fmt)}'
+    try:
+      self._flights.do(key, functools.partial(self._create, file_id, variant,
+                                              fmt))
+    except Exception: # pylint: disable=broad-except
+      LOGGER.exception('Unable to transcode %s to %s', key, fmt)
+    finally:
+      with self._lock:
+        self._queued.discard(key)
+
+  def submit(self, file_id: str, variant: Optional[str], fmt: str) -> None:
+    """ Create a transcode in the background, unless it's already queued. """
+    key = f'{file_id}_{get_variant(variant, fmt)}'
+    with self._lock:
+      if key in self._queued:
+        return
+      self._queued.add(key)
+
+    self.executor.submit(self._create_queued, file_id, variant, fmt)
+
+  def submit_all(self, file_id: str) -> None:
+    """ Create transcodes of an image in every format, in the background. """
+    for fmt in self.formats:
+      self.submit(file_id, None, fmt)
+
+  def read_file(self, file_id: str, variant: Optional[str],
+                fmt: str) -> Optional[io.IOBase]:
+    """ Read a transcode from storage, or return None if the PNG should be sent
+    instead. Missing transcodes are created in the background, and raise
+    FileNotFoundError.
+    """
+    try:
+      fobj = self.storage.read_file(file_id, get_variant(variant, fmt))
+    except FileNotFoundError:
+      self.submit(file_id, variant, fmt)
+      raise
+
+    # Checked without reading, since cloud storage files are streamed
+    ready = not (getattr(fobj, 'size', None) == 0 or (
+        fobj.seekable() and fobj.seek(0, io.SEEK_END) == 0))
+    self._ready.put(f'{file_id}_{get_variant(variant, fmt)}', ready)
+    if not ready:
+      fobj.close()
+      return None
+
+    if fobj.seekable():
+      fobj.seek(0)
+    return fobj
+
+  def is_ready(self, file_id: str, variant: Optional[str], fmt: str) -> bool:
+    """ Return whether a transcode should be sent instead of the PNG, as
+    read_file() does, but reading it at most once per process.
+    """
+    ready = self._ready.get(f'{file_id}_{get_variant(variant, fmt)}')
+    if ready is None:
+      fobj = self.read_file(file_id, variant, fmt)
+      ready = fobj is not None
+      if fobj:
+        fobj.close()
+
+    return ready
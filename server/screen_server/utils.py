@@ -1,7 +1,18 @@
 """ screen/ server shared utilities. """
 import base64
+import binascii
+import hashlib
+import re
 import secrets
 import time
+from typing import IO
+
+HASH_CHUNK_SIZE = 64 * 1024
+
+MIN_PREFIX_LENGTH = 3
+""" Length of the shortest word which is searched for as a prefix, since short
+prefixes match too many words to be searched quickly.
+"""
 
 def make_id() -> str:
   """ Create a UUID-style string from 8 bytes of timestamp + random bytes.
@@ -21,3 +32,55 @@ def make_id() -> str:
   # as well), etc, etc).
   byts = secrets.token_bytes(4) + int(time.time()).to_bytes(4, byteorder='big')
   return base64.b32encode(byts).decode('ascii').replace('=', '').lower()
+
+def encode_cursor(created: int, image_id: str) -> str:
+  """ Encode the position of an image in a listing as an opaque string. """
+  return base64.urlsafe_b64encode(
+      f'{created}:{image_id}'.encode('ascii')).decode('ascii')
+
+def decode_cursor(cursor: str) -> tuple[int, str]:
+  """ Decode a cursor from encode_cursor() into (created, image_id).
+  Raises ValueError if the cursor is invalid.
+  """
+  try:
+    created, image_id = base64.urlsafe_b64decode(
+        cursor.encode('ascii')).decode('ascii').split(':')
+    return int(created), image_id
+  except (binascii.Error, UnicodeError) as exc:
+    raise ValueError(f'Invalid cursor {cursor}') from exc
+
+def id_to_int(image_id: str) -> int:
+  """ Convert an ID from make_id() back into its 8 bytes, as a signed int. """
+  # IDs are 13 characters of unpadded base32
+  byts = base64.b32decode(image_id.upper() + '===')
+  return int.from_bytes(byts, byteorder='big', signed=True)
+
+def make_fts_query(query: str) -> str:
+  """ Convert user input into an SQLite FTS5 query matching all of its words.
+  The last word is treated as a prefix, to support search-as-you-type, unless
+  it's shorter than MIN_PREFIX_LENGTH.
+  """
+  words = re.findall(r'\w+', query)
+  # Words are quoted so that FTS5 syntax in the input isn't interpreted
+  terms = [f'"{word}"' for word in words]
+  if words and len(words[-1]) >= MIN_PREFIX_LENGTH:
+    terms[-1] += '*'
+  return ' '.join(terms)
+
+def make_user_key(user_id: str) -> str:
+  """ Return the search index token for a user's images.
+  It's the hex of the user ID, matching SQLite's hex(), so that it's a single
+  token however the ID would be tokenized.
+  """
+  return user_id.encode('utf-8').hex()
+
+def hash_file(stream: IO[bytes]) -> str:
+  """ Return the SHA-256 hex digest of a stream, rewinding it afterwards.
+  The stream is read in chunks, so large files aren't held in memory.
+  """
+  digest = hashlib.sha256()
+  stream.seek(0)
+  for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b''):
+    digest.update(chunk)
+  stream.seek(0)
+  return digest.hexdigest()
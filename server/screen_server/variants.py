@@ -0,0 +1,82 @@
+""" Generation of resized image variants (thumbnails, previews). """
+import concurrent.futures
+import functools
+import io
+import logging
+
+from PIL import Image as PILImage
+from werkzeug import datastructures
+
+from screen_server.storage import singleflight
+from screen_server.storage import storage
+
+LOGGER = logging.getLogger(__name__)
+
+VARIANTS: dict[str, tuple[int, int]] = {
+  # Gallery tiles
+  'thumbnail': (320, 240),
+  # Link previews (unfurls), which are typically 1200x630
+  'preview': (1200, 630),
+}
+""" Variant names and the (width, height) box each is resized to fit in. """
+
+class VariantService():
+  """ Creates and reads resized variants of images in a StorageService. """
+  def __init__(self, config: dict[str, str], store: storage.StorageService):
+    self.storage = store
+    self.executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=int(config.get('VARIANT_WORKERS') or 2),
+        thread_name_prefix='variants')
+    self._flights: singleflight.SingleFlight[bytes] = (
+        singleflight.SingleFlight())
+
+  @classmethod
+  def is_variant(cls, variant: str) -> bool:
+    """ Check whether variant is a known variant name. """
+    return variant in VARIANTS
+
+  def _render(self, file_id: str, variant: str) -> bytes:
+    """ Resize the original image to the variant's size, as PNG bytes. """
+    with self.storage.read_file(file_id) as fobj:
+      img = PILImage.open(fobj)
+      img.thumbnail(VARIANTS[variant])
+
+      out = io.BytesIO()
+      img.save(out, format='PNG', optimize=True)
+
+    return out.getvalue()
+
+  def _create(self, file_id: str, variant: str) -> bytes:
+    """ Render the variant and save it to storage. """
+    data = self._render(file_id, variant)
+    self.storage.write_file(
+        file_id, datastructures.FileStorage(io.BytesIO(data)), variant)
+    LOGGER.debug('Created %s variant for %s', variant, file_id)
+    return data
+
+  def _create_all(self, file_id: str) -> None:
+    """ Create all variants for an image, logging any failures. """
+    for variant in VARIANTS:
+      try:
+        self._flights.do(f'{file_id}_{variant}',
+                         functools.partial(self._create, file_id, variant))
+      except Exception: # pylint: disable=broad-except
+        LOGGER.exception('Unable to create %s variant for %s', variant,
+                         file_id)
+
+  def submit(self, file_id: str) -> concurrent.futures.Future[None]:
+    """ Create all variants for an image in the background. """
+    return self.executor.submit(self._create_all, file_id)
+
+  def read_file(self, file_id: str, variant: str) -> io.IOBase:
+    """ Read a variant from storage, creating it first if it doesn't exist. """
+    try:
+      return self.storage.read_file(file_id, variant)
+    except FileNotFoundError:
+      pass
+
+    # Variants are created lazily for images uploaded before variants existed,
+    # or if the background job failed
+    data = self._flights.do(f'{file_id}_{variant}',
+                            functools.partial(self._create, file_id, variant))
+    return io.BytesIO(data)
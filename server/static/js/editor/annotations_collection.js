@@ -30,7 +30,7 @@ export class AnnotationsCollection {
         this.annotation_element.appendChild($li);
         if (is_brand_new) {
             this.ss.annotations = this.annotations;
-            this.ss.save();
+            this.ss.patch([{ op: "append", annotation: annotation }]);
         }
     }
     removeAnnotation(annotation) {
@@ -38,7 +38,7 @@ export class AnnotationsCollection {
         this.annotations.splice(idx, 1);
         this.drawAll();
         this.ss.annotations = this.annotations;
-        this.ss.save();
+        this.ss.patch([{ op: "delete", index: idx }]);
     }
     drawAll(plus_one) {
         this.context.clearRect(0, 0, this.canvas.width, this.canvas.height);
@@ -85,7 +85,7 @@ export class AnnotationsCollection {
     // When the annotation was built from the server response we don't save
     if (is_brand_new) {
       this.ss.annotations = this.annotations;
-      this.ss.save();
+      this.ss.patch([{ op: "append", annotation: annotation }]);
     }
   }
 
@@ -97,7 +97,7 @@ export class AnnotationsCollection {
     this.drawAll();
 
     this.ss.annotations = this.annotations;
-    this.ss.save();
+    this.ss.patch([{ op: "delete", index: idx }]);
   }
 
   /**
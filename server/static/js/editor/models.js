@@ -16,6 +16,8 @@ export class Screenshot {
         this.status = "";
         this.created = 0;
         this.updated = 0;
+        this.pending_patch = Promise.resolve();
+        this.patch_failed = false;
     }
     get image_url() {
         return this.data_img_url ? this.data_img_url : `/i/${this.image_id}.png`;
@@ -48,6 +50,39 @@ export class Screenshot {
             body: JSON.stringify(this),
         });
     }
+    patch(ops) {
+        this.pending_patch = this.pending_patch.then(async () => {
+            if (this.patch_failed) {
+                console.warn("Not saving screenshot changes until reload", ops);
+                return;
+            }
+            let status = 0;
+            try {
+                const response = await fetch(`/api/v1/images/${this.image_id}`, {
+                    method: "PATCH",
+                    headers: {
+                        Accept: "application/json",
+                        "Content-Type": "application/json",
+                    },
+                    body: JSON.stringify({ updated: this.updated, ops: ops }),
+                });
+                status = response.status;
+                if (response.ok) {
+                    this.updated = (await response.json()).updated;
+                    return;
+                }
+                console.error("Unable to save screenshot", await response.text());
+            }
+            catch (err) {
+                console.error("Unable to save screenshot", err);
+            }
+            this.patch_failed = true;
+            alert(status === 409
+                ? "This screenshot was changed elsewhere. Reload to see the latest version."
+                : "Unable to save changes to this screenshot. Reload to see the saved version.");
+        });
+        return this.pending_patch;
+    }
     static async get(image_id) {
         return this.parse(fetch(`/api/v1/images/${image_id}`));
     }
@@ -41,6 +41,12 @@ export class Screenshot {
   // just as if it were using a file from the server
   private data_img_url?: string;
 
+  /** @property The most recent PATCH, so that patches are sent in order */
+  private pending_patch: Promise<void> = Promise.resolve();
+
+  /** @property Whether a PATCH failed, so that no more are sent */
+  private patch_failed: boolean = false;
+
   /** @property URL for the screenshot image */
   get image_url(): string {
     return this.data_img_url ? this.data_img_url : `/i/${this.image_id}.png`;
@@ -98,6 +104,54 @@ export class Screenshot {
     });
   }
 
+  /**
+   * @method Save annotation changes to the server (PATCH).
+   *     Patches are sent one at a time since each must include the `updated`
+   *     value returned by the previous one. The server rejects a patch if the
+   *     screenshot was changed elsewhere. Once a patch fails, no more are sent
+   *     until the page is reloaded.
+   * @param ops Annotation operations, e.g. `{op: "delete", index: 0}`
+   */
+  patch(ops: Array<object>): Promise<void> {
+    this.pending_patch = this.pending_patch.then(async () => {
+      if (this.patch_failed) {
+        console.warn("Not saving screenshot changes until reload", ops);
+        return;
+      }
+
+      let status = 0;
+      try {
+        const response = await fetch(`/api/v1/images/${this.image_id}`, {
+          method: "PATCH",
+          headers: {
+            Accept: "application/json",
+            "Content-Type": "application/json",
+          },
+          body: JSON.stringify({ updated: this.updated, ops: ops }),
+        });
+        status = response.status;
+        if (response.ok) {
+          this.updated = (await response.json()).updated;
+          return;
+        }
+        console.error("Unable to save screenshot", await response.text());
+      } catch (err) {
+        console.error("Unable to save screenshot", err);
+      }
+
+      // Operations refer to annotations by index, so after a failure they may
+      // not match the annotations on the server
+      this.patch_failed = true;
+      alert(
+        status === 409
+          ? "This screenshot was changed elsewhere. Reload to see the latest version."
+          : "Unable to save changes to this screenshot. Reload to see the saved version."
+      );
+    });
+
+    return this.pending_patch;
+  }
+
   /** @mmethod GET `Screenshot` from server based on ID */
   static async get(image_id: string): Promise<Screenshot> {
     return this.parse(fetch(`/api/v1/images/${image_id}`));
@@ -0,0 +1,65 @@
+""" Tests for the Bloom filter of image IDs.
+
+Run from the server directory:
+
+  python -m unittest discover tests
+"""
+import pathlib
+import tempfile
+import threading
+import unittest
+
+from screen_server import bloom
+
+ROUNDS = 200
+TIMEOUT_SECONDS = 5
+
+class BloomFilterTest(unittest.TestCase):
+  """ Tests for BloomFilter. """
+  def setUp(self):
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    self.source: list[str] = []
+    self.filter = bloom.BloomFilter(
+        pathlib.Path(self.tmp_dir.name) / 'ids', 100, 0.01,
+        lambda: len(self.source), lambda: list(self.source))
+
+  def tearDown(self):
+    self.tmp_dir.cleanup()
+
+  def test_lookup_while_adding(self):
+    """ A lookup which (re)opens the file doesn't deadlock with an add. """
+    def insert(item: str):
+      with self.filter.adding([item]):
+        self.source.append(item)
+
+    for index in range(ROUNDS):
+      # Forces the lookup to open the file, as on first use in a process
+      self.filter._mmap = None # pylint: disable=protected-access
+      barrier = threading.Barrier(2)
+      item = f'item{index}'
+      threads = [
+          threading.Thread(target=lambda: (barrier.wait(), insert(item)),
+                           daemon=True),
+          threading.Thread(target=lambda: (barrier.wait(), 'x' in self.filter),
+                           daemon=True)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join(TIMEOUT_SECONDS)
+        self.assertFalse(thread.is_alive(), f'Deadlocked in round {index}')
+      self.assertIn(item, self.filter)
+
+  def test_resize_when_full(self):
+    """ Adding past the capacity resizes the filter and keeps every item. """
+    for index in range(150):
+      with self.filter.adding([f'item{index}']):
+        self.source.append(f'item{index}')
+
+    mapped = self.filter._get_mmap() # pylint: disable=protected-access
+    self.assertGreater(bloom.HEADER.unpack_from(mapped)[3], 150)
+    for index in range(150):
+      self.assertIn(f'item{index}', self.filter)
+
+
+if __name__ == '__main__':
+  unittest.main()